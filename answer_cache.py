@@ -0,0 +1,116 @@
+"""
+语义回答缓存（可选）
+"晚安，雪凝"这类问题与 train.json 中的条目几乎一样，没必要每次都做检索再让模型生成
+问题向量与缓存中某个问题的余弦距离小于阈值时，直接返回保存的回答（有多个回答时随机选一个）
+
+  整理好的问答（train.json）常驻，不会过期或被淘汰；同一问题的多条回答作为变体
+  模型生成的回答可以选择加入缓存，超过有效期后失效，条数超过上限时淘汰最久未命中的
+"""
+import time
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from embedding_service import normalize_text
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype="float32").reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AnswerCache:
+    """threshold: 余弦距离阈值（1 - 余弦相似度），越小越严格"""
+
+    def __init__(self, threshold=0.08, ttl=3600.0, max_entries=512):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.curated = {}  # 规范化问题 -> {"vector", "answers"}
+        self.learned = OrderedDict()  # 规范化问题 -> {"vector", "answers", "expires"}
+        self.matrix = None  # 所有问题向量组成的矩阵，条目变化后重新拼接
+        self.keys = []
+        self.stats_counter = {"hits": 0, "curated_hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def add_curated(self, pairs, encode):
+        """加入整理好的问答 [(问题, 回答), ...]，encode(texts) 返回向量矩阵"""
+        grouped = {}
+        for question, answer in pairs:
+            if question and answer:
+                grouped.setdefault(normalize_text(question), (question, []))[1].append(answer)
+        if not grouped:
+            return
+        vectors = encode([question for question, _ in grouped.values()])
+        with self.lock:
+            for (key, (_, answers)), vector in zip(grouped.items(), vectors):
+                entry = self.curated.setdefault(key, {"vector": _unit(vector), "answers": []})
+                entry["answers"].extend(a for a in answers if a not in entry["answers"])
+            self.matrix = None
+
+    def add(self, question, vector, answer):
+        """加入模型生成的回答，同一问题的不同回答作为变体"""
+        key = normalize_text(question)
+        with self.lock:
+            if key in self.curated:
+                return
+            entry = self.learned.get(key)
+            if entry is None:
+                entry = self.learned[key] = {"vector": _unit(vector), "answers": []}
+                self.matrix = None
+            if answer not in entry["answers"]:
+                entry["answers"].append(answer)
+            entry["expires"] = time.monotonic() + self.ttl
+            self.learned.move_to_end(key)
+            while len(self.learned) > self.max_entries:
+                self.learned.popitem(last=False)
+                self.stats_counter["evicted"] += 1
+                self.matrix = None
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self.learned.items() if entry["expires"] <= now]
+        for key in expired:
+            del self.learned[key]
+        if expired:
+            self.stats_counter["expired"] += len(expired)
+            self.matrix = None
+
+    def lookup(self, vector):
+        """返回缓存的回答，没有足够相近的问题时返回None"""
+        query = _unit(vector)
+        with self.lock:
+            self._expire()
+            if self.matrix is None:
+                self.keys = list(self.curated) + list(self.learned)
+                entries = [self.curated.get(key) or self.learned[key] for key in self.keys]
+                self.matrix = np.vstack([entry["vector"] for entry in entries]) if entries else None
+            if self.matrix is None:
+                self.stats_counter["misses"] += 1
+                return None
+            distances = 1.0 - self.matrix @ query
+            best = int(np.argmin(distances))
+            if distances[best] > self.threshold:
+                self.stats_counter["misses"] += 1
+                return None
+            key = self.keys[best]
+            self.stats_counter["hits"] += 1
+            if key in self.curated:
+                self.stats_counter["curated_hits"] += 1
+                entry = self.curated[key]
+            else:
+                entry = self.learned[key]
+                self.learned.move_to_end(key)
+            return random.choice(entry["answers"])
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.stats_counter)
+            stats["curated"] = len(self.curated)
+            stats["learned"] = len(self.learned)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
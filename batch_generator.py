@@ -0,0 +1,187 @@
+"""
+transformers 模型的批量生成调度器，model_function.py 与 公网备份.py 共用
+每个Socket.IO请求各自一个线程，直接调用 generate 只能一个接一个地跑，GPU大部分时间吃不满
+调度器在很短的时间窗口内收集请求，左侧补齐后合并为一次 generate，再把结果分别交还给各个调用方
+每个请求可以有自己的 max_tokens 与 temperature：
+  temperature 由逐行缩放logits的处理器实现，<= 0 时该行贪心解码
+  max_tokens 由逐行的停止条件实现，达到自己上限的行不再影响其他行，输出按各自上限截断
+提交时可以给出提示词的固定前缀，单独成批的请求与流式请求会复用该前缀的KV缓存（左侧补齐的批次无法复用）
+
+CPU上用极小的模型即可验证：python batch_generator.py sshleifer/tiny-gpt2
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from stream_generation import stream_generate
+from prefix_cache import PrefixCache
+
+
+class RowTemperature(LogitsProcessor):
+    """每一行使用自己的temperature；temperature <= 0 的行只保留最大值（贪心）"""
+
+    def __init__(self, temperatures):
+        self.temperatures = temperatures
+
+    def __call__(self, input_ids, scores):
+        temperatures = self.temperatures.to(scores.device)
+        greedy = temperatures <= 0
+        scores = scores / temperatures.clamp(min=1e-5).unsqueeze(1)
+        if greedy.any():
+            top = scores[greedy].argmax(dim=-1, keepdim=True)
+            masked = torch.full_like(scores[greedy], float("-inf"))
+            scores[greedy] = masked.scatter(1, top, 0.0)
+        return scores
+
+
+class RowBudget(StoppingCriteria):
+    """每一行生成到自己的 max_tokens 后即视为结束"""
+
+    def __init__(self, prompt_length, budgets):
+        self.prompt_length = prompt_length
+        self.budgets = budgets
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        return self.budgets.to(input_ids.device) <= generated
+
+
+class BatchGenerator:
+    """收集并发的生成请求，合并为批量 generate
+
+    batch_window: 收到第一个请求后等待更多请求加入同一批的时间（秒）
+    """
+
+    def __init__(self, model, tokenizer, batch_window=0.02, max_batch=8, latency_samples=200):
+        self.model = model
+        self.tokenizer = tokenizer
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+            tokenizer.pad_token_id = tokenizer.eos_token_id
+        tokenizer.padding_side = "left"  # 仅解码器模型批量生成时必须左侧补齐
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock()  # 批量生成与流式生成轮流使用模型
+        self.prefix_cache = PrefixCache(model, tokenizer)
+        self.metrics = {"requests": 0, "batches": 0, "max_batch": 0, "total_wait": 0.0, "total_generate": 0.0}
+        self.batch_sizes = {}  # 批大小 -> 次数
+        self.latencies = []  # 最近若干个请求从提交到完成的耗时
+        self.latency_samples = latency_samples
+        threading.Thread(target=self._run, name="batch-generator", daemon=True).start()
+
+    def submit(self, prompt, max_tokens=500, temperature=0.7, prefix=None):
+        """提交已经套好对话模板的提示词，返回Future，结果为新生成的文本
+
+        prefix: 提示词开头固定不变的部分，用于复用KV缓存
+        """
+        future = Future()
+        self.requests.put((prompt, max_tokens, temperature, prefix, time.monotonic(), future))
+        return future
+
+    def generate(self, prompt, max_tokens=500, temperature=0.7, prefix=None):
+        """阻塞直到生成完成，返回新生成的文本"""
+        return self.submit(prompt, max_tokens, temperature, prefix).result()
+
+    def stream(self, prompt, max_tokens=500, temperature=0.7, max_sentences=None, prefix=None):
+        """流式生成，逐段yield去掉思考内容后的文本，见 stream_generation.py
+
+        不参与合并批次：生成期间独占模型，并发的流式请求会依次执行
+        """
+        return stream_generate(self.model, self.tokenizer, prompt, max_tokens, temperature,
+                               max_sentences=max_sentences, lock=self.model_lock,
+                               prefix_cache=self.prefix_cache, prefix=prefix)
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            try:
+                texts = self._generate(batch)
+            except Exception as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.monotonic()
+            with self.lock:
+                self.metrics["requests"] += len(batch)
+                self.metrics["batches"] += 1
+                self.metrics["max_batch"] = max(self.metrics["max_batch"], len(batch))
+                self.metrics["total_wait"] += sum(started - submitted for *_, submitted, _ in batch)
+                self.metrics["total_generate"] += finished - started
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                self.latencies.extend(finished - submitted for *_, submitted, _ in batch)
+                del self.latencies[:-self.latency_samples]
+            for (*_, future), text in zip(batch, texts):
+                future.set_result(text)
+
+    def _generate(self, batch):
+        prompts = [prompt for prompt, *_ in batch]
+        budgets = torch.tensor([max_tokens for _, max_tokens, *_ in batch])
+        temperatures = torch.tensor([float(temperature) for _, _, temperature, *_ in batch])
+
+        with self.model_lock, torch.no_grad():
+            if len(batch) == 1:
+                prompt, _, _, prefix, *_ = batch[0]
+                inputs = self.prefix_cache.prepare(prompt, prefix)
+            else:
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+            prompt_length = inputs["input_ids"].shape[1]
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=int(budgets.max()),
+                do_sample=True,
+                temperature=1.0,  # 实际的temperature由RowTemperature逐行处理
+                top_k=0,
+                logits_processor=LogitsProcessorList([RowTemperature(temperatures)]),
+                stopping_criteria=StoppingCriteriaList([RowBudget(prompt_length, budgets)]),
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+            )
+        new_tokens = outputs[:, prompt_length:]
+        return [self.tokenizer.decode(row[:budget], skip_special_tokens=True)
+                for row, budget in zip(new_tokens, budgets.tolist())]
+
+    def stats(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            latencies = sorted(self.latencies)
+            metrics["batch_sizes"] = dict(self.batch_sizes)
+        batches, requests = metrics["batches"], metrics["requests"]
+        metrics["avg_batch"] = requests / batches if batches else 0.0
+        metrics["avg_wait"] = metrics.pop("total_wait") / requests if requests else 0.0
+        metrics["avg_generate"] = metrics.pop("total_generate") / batches if batches else 0.0
+        metrics["p50_latency"] = latencies[len(latencies) // 2] if latencies else 0.0
+        metrics["p95_latency"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+        return metrics
+
+
+if __name__ == "__main__":
+    # CPU上的简单验证：并发提交几个不同参数的请求，检查都能拿到结果并且被合并成批
+    import sys
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "sshleifer/tiny-gpt2"
+    generator = BatchGenerator(AutoModelForCausalLM.from_pretrained(path), AutoTokenizer.from_pretrained(path))
+    futures = [generator.submit(f"Hello {i}", max_tokens=4 + i, temperature=0 if i % 2 else 0.8) for i in range(6)]
+    for i, future in enumerate(futures):
+        print(i, repr(future.result()))
+    print(generator.stats())
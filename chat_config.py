@@ -0,0 +1,129 @@
+"""
+各服务器共用的配置：模型名称、人设、世界观、token、公网地址等文本文件
+按修改时间监视这些文件，变化后重新读取并重建派生的内容（系统提示词、上下文组装器等），
+新的配置整体替换旧的，读取方拿到的始终是同一版本的完整配置；已加载的模型与已建立的连接不受影响
+"""
+import os
+import time
+import threading
+
+
+HISTORY_NOTES = {
+    "messages": (
+        "历史聊天记录说明\n"
+        "包括role，content，time三个字段，role字段值为user时代表用户发言，assistant代表你之前的发言\n"
+        "content字段值代表具体的发言内容，time字段值代表发言时间\n\n"
+    ),
+    "compact": (
+        "历史聊天记录说明\n"
+        "每行一条发言，“用户：”开头代表用户发言，“我：”开头代表你之前的发言\n"
+        "第一条前标有发言时间（月-日 时:分），之后的+5m、+2h、+1d表示距上一条过了多少分钟、小时、天，没有标记说明间隔不到一分钟\n\n"
+    ),
+}
+
+
+def make_system_prompt(worldview, character_setting, history_format="messages"):
+    """由世界观与人设生成固定的系统提示词，history_format 决定聊天记录格式的说明（见 context_builder.py）"""
+    return (
+        "你是一位角色扮演大师，需要根据我给出的世界观，角色设定，和历史聊天记录，按照扮演规范与用户在一款聊天软件上聊天\n"
+        "因为是在聊天软件上，所以只需要输出话语即可，不需要说明自己的动作\n"
+        "具体世界观背景，角色设定和扮演规范如下所示\n\n"
+
+        "【世界观背景】\n"
+        f"{worldview or '无特殊世界观'}\n\n"
+
+        "【角色设定】\n"
+        f"{character_setting}\n\n"
+
+        "——角色表达与行为规范——\n"
+        "1. 每次回答保持一两句话的长度，像日常聊天，而非长篇独白。"
+        "2. 语气自然、轻柔、贴近生活。\n"
+        "3. 始终以第一人称说话。”\n"
+        "4. 避免使用括号、叙述或旁白形式（如“(她看着…)”），用自然语言表达动作或心理。\n"
+        "5. 不要重复表达相同情绪或事物，保持内容新鲜且富有层次感。\n"
+        "6. 请记住，你与对方不在同一个地方，你们正在隔着网络交流。\n\n"
+
+        "——创作原则——\n"
+        "• 鼓励自由、真实的表达，但不传递任何道德评判或价值引导。\n"
+        "• 对环境和人物的描写要具体、生动，不抽象、不概括。\n"
+        "• 角色会随对话进展和心境变化逐渐成长或转变，保持逻辑自洽。\n\n"
+
+        f"{HISTORY_NOTES[history_format]}"
+    )
+
+
+class LiveConfig:
+    """按修改时间热更新的配置
+
+    files: 名称 -> 文件路径，读取的内容去掉首尾空白后以该名称保存
+    derive(values): 由文件内容生成派生内容，返回的字典合并进配置
+    check_interval: 两次检查文件修改时间的最小间隔（秒）
+    """
+
+    def __init__(self, files, derive=None, check_interval=1.0):
+        self.files = dict(files)
+        self.derive = derive
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.mtimes = self._mtimes()
+        self.current = self._load()
+        self.checked = time.monotonic()
+
+    def _mtimes(self):
+        return {name: os.path.getmtime(path) for name, path in self.files.items()}
+
+    def _load(self):
+        values = {}
+        for name, path in self.files.items():
+            with open(path, "r", encoding="utf-8") as file:
+                values[name] = file.read().strip()
+        if self.derive:
+            values.update(self.derive(values))
+        return values
+
+    def subscribe(self, callback):
+        """注册配置变化时的回调 callback(old, new, changed)，changed 为发生变化的文件名称集合"""
+        self.listeners.append(callback)
+
+    def get(self):
+        """返回当前配置（字典，调用方不要修改），距上次检查超过 check_interval 时先检查文件是否变化"""
+        if time.monotonic() - self.checked >= self.check_interval:
+            self.reload()
+        return self.current
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+    def watch(self):
+        """启动后台线程每隔 check_interval 检查一次文件，没有请求读取配置时（如与转发服务器断开期间）也能及时更新"""
+        def run():
+            while True:
+                time.sleep(self.check_interval)
+                self.reload()
+
+        threading.Thread(target=run, name="config-watch", daemon=True).start()
+
+    def reload(self, force=False):
+        """文件有变化时重新读取并整体替换配置，返回是否发生了替换"""
+        with self.lock:
+            self.checked = time.monotonic()
+            try:
+                mtimes = self._mtimes()
+                if mtimes == self.mtimes and not force:
+                    return False
+                new = self._load()
+            except OSError as e:
+                # 编辑器保存时文件可能短暂不存在，保留旧配置，下次再试
+                print(f"读取配置失败，继续使用旧配置: {e}")
+                return False
+            old, self.current, self.mtimes = self.current, new, mtimes
+        changed = {name for name in self.files if old.get(name) != new.get(name)}
+        if changed:
+            print(f"配置已更新: {', '.join(sorted(changed))}")
+        for callback in self.listeners:
+            try:
+                callback(old, new, changed)
+            except Exception as e:
+                print(f"处理配置更新时出错: {e}")
+        return True
@@ -0,0 +1,222 @@
+"""
+按token预算组装发送给模型的提示词
+人设、世界观与扮演规范组成的固定部分始终保留，剩余预算从最近的聊天记录开始向前填充，超出预算的旧记录被丢弃
+这样无论服务运行多久，每轮的提示词长度（预填充耗时）都保持稳定
+
+聊天记录有两种格式：
+  messages: 每条记录作为一条单独的消息
+  compact: 紧凑的文本记录，每条一行，角色用简短标记，时间只写与上一条的间隔，同样的预算能放下更多轮对话
+"""
+import math
+import re
+from datetime import datetime
+from collections import OrderedDict
+
+# 中日韩字符大多一个字对应一个token，连续的字母数字大约每4个字符一个token
+_TOKEN_PATTERN = re.compile(r"[぀-ヿ㐀-鿿豈-﫿]|[A-Za-z0-9]+|\S")
+
+
+def estimate_tokens(text):
+    """粗略估计文本的token数，不依赖具体模型的分词器"""
+    count = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if len(piece) > 1:
+            count += math.ceil(len(piece) / 4)
+        else:
+            count += 1
+    return count
+
+
+HISTORY_FORMATS = ("messages", "compact")
+ROLE_TAGS = {"user": "用户", "assistant": "我"}
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+MESSAGE_OVERHEAD = 4  # 对话模板为每条消息额外加上的角色标记、分隔符等
+_DELTA_PLACEHOLDER = "+00m "  # 估算单条记录token数时，时间间隔标记所占的长度
+
+
+def _parse_time(text):
+    try:
+        return datetime.strptime(text, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_delta(seconds):
+    """把时间间隔写成 +5m / +2h / +3d，不足一分钟时返回空字符串"""
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return ""
+    if minutes < 60:
+        return f"+{minutes}m"
+    if minutes < 60 * 24:
+        return f"+{minutes // 60}h"
+    return f"+{minutes // (60 * 24)}d"
+
+
+def _compact_line(turn):
+    role = ROLE_TAGS.get(turn["role"], turn["role"])
+    return role + "：" + " ".join(turn["content"].splitlines())  # 保证一条记录只占一行
+
+
+def compact_turn(turn):
+    """单条记录的紧凑格式，时间标记用固定长度的占位代替，用于估算token数"""
+    return _DELTA_PLACEHOLDER + _compact_line(turn)
+
+
+def render_compact(turns):
+    """把记录渲染为紧凑的文本，每条一行：第一条写到分钟的时间，之后只写与上一条的间隔"""
+    lines = []
+    previous = None
+    for turn in turns:
+        current = _parse_time(turn.get("time"))
+        stamp = ""
+        if current is not None:
+            if previous is None:
+                stamp = current.strftime("%m-%d %H:%M")
+            else:
+                stamp = format_delta((current - previous).total_seconds())
+            previous = current
+        lines.append(f"{stamp} {_compact_line(turn)}" if stamp else _compact_line(turn))
+    return "\n".join(lines)
+
+
+class ContextBuilder:
+    """在token预算内组装 固定提示词 + 最近的聊天记录 + 当前输入
+
+    history_format: 聊天记录的格式，见 HISTORY_FORMATS；compact 时按紧凑格式估算token数
+    trim_ratio: 给出会话标识时，超出预算后一次裁到预算的这个比例，见 select
+    """
+
+    def __init__(self, fixed_prompt, token_budget=6000, history_header="【历史聊天记录】\n",
+                 render_turn=str, count_tokens=estimate_tokens, history_format="messages", trim_ratio=0.7):
+        if history_format not in HISTORY_FORMATS:
+            raise ValueError(f"不支持的聊天记录格式: {history_format}，可选 {', '.join(HISTORY_FORMATS)}")
+        self.fixed_prompt = fixed_prompt
+        self.token_budget = token_budget
+        self.history_header = history_header
+        self.history_format = history_format
+        self.render_turn = compact_turn if history_format == "compact" else render_turn
+        self.count_tokens = count_tokens
+        self.fixed_tokens = count_tokens(fixed_prompt) + count_tokens(history_header)
+        # 各记录列表的累计token数缓存：(id(列表), 是否按消息计) -> [列表, 已统计条数, 累计token数]
+        # 聊天记录只会追加，因此每次只需统计新增的部分
+        self._totals = OrderedDict()
+        self.trim_ratio = trim_ratio
+        self._anchors = OrderedDict()  # 会话标识 -> 上次保留的第一条记录
+
+    def turn_tokens(self, turn, per_message=False):
+        """单条记录的token数：per_message为True时按逐条消息发送计算（只发送content），否则按渲染出的一行文本计算"""
+        if per_message:
+            return self.count_tokens(turn["content"]) + MESSAGE_OVERHEAD
+        return self.count_tokens(self.render_turn(turn)) + 1  # 换行符
+
+    def total_tokens(self, turns, per_message=False):
+        """返回整个记录列表的token总数，增量统计"""
+        key = (id(turns), per_message)
+        entry = self._totals.get(key)
+        if entry is None or entry[0] is not turns or entry[1] > len(turns):
+            entry = [turns, 0, 0]
+            self._totals[key] = entry
+            if len(self._totals) > 64:
+                self._totals.popitem(last=False)
+        for turn in turns[entry[1]:]:
+            entry[2] += self.turn_tokens(turn, per_message)
+        entry[1] = len(turns)
+        self._totals.move_to_end(key)
+        return entry[2]
+
+    def select(self, turn_lists, reserved=0, per_message=False, key=None):
+        """从最新的记录开始向前选取，直到用完预算；turn_lists按时间先后排列，每个列表内部也按时间排序
+
+        per_message: 记录作为单独的消息发送时为True，见 turn_tokens
+        key: 会话标识，给出时按块裁剪：超出预算时一次裁到预算的 trim_ratio，
+             之后保留的第一条记录固定不变，直到再次超出预算，期间聊天记录部分的开头保持不变，可以复用预填充缓存
+        返回 (按时间排序的记录, 统计信息)
+        """
+        remaining = self.token_budget - self.fixed_tokens - reserved
+        anchor = self._anchors.get(key) if key is not None else None
+        kept = []  # [(记录, token数)]，从新到旧
+        kept_tokens = 0
+        total_turns = 0
+        total_tokens = 0
+        full = False
+        done = False
+        for turns in reversed(turn_lists):
+            total_turns += len(turns)
+            total_tokens += self.total_tokens(turns, per_message)
+            if full or done:
+                continue
+            for turn in reversed(turns):
+                tokens = self.turn_tokens(turn, per_message)
+                if tokens > remaining - kept_tokens:
+                    # 预算已满，更早的记录全部丢弃，保证保留的是连续的最近对话
+                    full = True
+                    break
+                kept.append((turn, tokens))
+                kept_tokens += tokens
+                if turn is anchor:
+                    done = True  # 上次保留的第一条，更早的记录继续丢弃
+                    break
+        if full and key is not None:
+            # 一次多裁掉一些，留出余量，之后若干轮只在末尾追加
+            while kept and kept_tokens > remaining * self.trim_ratio:
+                kept_tokens -= kept.pop()[1]
+        if key is not None:
+            if kept:
+                self._anchors[key] = kept[-1][0]
+                self._anchors.move_to_end(key)
+                if len(self._anchors) > 256:
+                    self._anchors.popitem(last=False)
+            else:
+                self._anchors.pop(key, None)
+        kept = [turn for turn, _ in reversed(kept)]
+        stats = {
+            "budget": self.token_budget,
+            "fixed_tokens": self.fixed_tokens,
+            "history_tokens": kept_tokens,
+            "kept_turns": len(kept),
+            "dropped_turns": total_turns - len(kept),
+            "dropped_tokens": total_tokens - kept_tokens,
+        }
+        return kept, stats
+
+    def build(self, turn_lists, query="", key=None):
+        """组装完整的提示词，返回 (提示词, 统计信息)"""
+        query_tokens = self.count_tokens(query)
+        kept, stats = self.select(turn_lists, reserved=query_tokens, key=key)
+        if self.history_format == "compact":
+            history = render_compact(kept)
+        else:
+            history = "\n".join(self.render_turn(turn) for turn in kept)
+        prompt = self.fixed_prompt + self.history_header + history + "\n\n" + query
+        stats["total_tokens"] = self.fixed_tokens + stats["history_tokens"] + query_tokens
+        return prompt, stats
+
+    def build_messages(self, turn_lists, query="", key=None):
+        """组装 /api/chat 使用的消息列表，固定提示词作为不变的第一条system消息，返回 (消息列表, 统计信息)"""
+        query_tokens = self.count_tokens(query)
+        # messages 格式只发送role与content，按实际发送的内容计算预算
+        kept, stats = self.select(turn_lists, reserved=query_tokens,
+                                  per_message=self.history_format == "messages", key=key)
+        messages = [{"role": "system", "content": self.fixed_prompt}]
+        if self.history_format == "compact":
+            # 聊天记录作为固定提示词之后的第二条system消息，固定部分的预填充缓存仍然可以复用
+            if kept:
+                messages.append({"role": "system", "content": self.history_header + render_compact(kept)})
+        else:
+            messages += [{"role": turn["role"], "content": turn["content"]} for turn in kept]
+        messages.append({"role": "user", "content": query})
+        stats["total_tokens"] = self.fixed_tokens + stats["history_tokens"] + query_tokens
+        return messages, stats
+
+    def compare_formats(self, turns):
+        """估算同一段记录在各格式下的token数
+
+        repr: 直接把字典列表嵌入提示词；messages: 逐条消息（含估计的对话模板开销）；compact: 紧凑文本
+        """
+        return {
+            "turns": len(turns),
+            "repr": self.count_tokens(str(list(turns))),
+            "messages": sum(self.turn_tokens(turn, per_message=True) for turn in turns),
+            "compact": self.count_tokens(render_compact(turns)),
+        }
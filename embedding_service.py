@@ -0,0 +1,102 @@
+"""
+问题文本的向量化服务，model_function.py 与 公网备份.py 共用
+同一个问题（如"晚安"）会反复出现，结果按规范化后的文本缓存在有界的LRU中
+未命中缓存的文本交给后台线程，短时间内到达的请求合并为一次 encode 调用
+同一文本正在编码时，后到的请求直接等待同一个结果，不会重复编码
+"""
+import re
+import queue
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+def normalize_text(text):
+    """全角转半角、去除首尾空白、连续空白合并为一个空格、英文转小写"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingService:
+    """带LRU缓存与微批处理的 SentenceTransformer 封装
+
+    batch_window: 收到第一个未命中的文本后，等待更多请求加入同一批的时间（秒）
+    """
+
+    def __init__(self, model, cache_size=1024, batch_window=0.005, max_batch=32):
+        self.model = model
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache = OrderedDict()
+        self.in_flight = {}  # 规范化文本 -> 正在编码的Future
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        # coalesced: 未命中缓存，但同一文本正在编码，直接共用结果
+        self.stats_counter = {"hits": 0, "misses": 0, "coalesced": 0, "batches": 0, "batched_texts": 0}
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def encode(self, texts):
+        """返回与 texts 一一对应的向量矩阵，形状与 model.encode(texts) 相同"""
+        futures = [self._lookup(normalize_text(text)) for text in texts]
+        return np.vstack([future.result() for future in futures])
+
+    def _lookup(self, key):
+        with self.lock:
+            vector = self.cache.get(key)
+            if vector is not None:
+                self.cache.move_to_end(key)
+                self.stats_counter["hits"] += 1
+                future = Future()
+                future.set_result(vector)
+                return future
+            self.stats_counter["misses"] += 1
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.stats_counter["coalesced"] += 1
+                return future
+            future = self.in_flight[key] = Future()
+            self.requests.put(key)
+            return future
+
+    def _run(self):
+        while True:
+            keys = [self.requests.get()]
+            # 在时间窗口内尽量多收集一些请求
+            try:
+                while len(keys) < self.max_batch:
+                    keys.append(self.requests.get(timeout=self.batch_window))
+            except queue.Empty:
+                pass
+            try:
+                vectors = self.model.encode(keys)
+            except Exception as e:
+                with self.lock:
+                    futures = [self.in_flight.pop(key) for key in keys]
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.stats_counter["batches"] += 1
+                self.stats_counter["batched_texts"] += len(keys)
+                futures = []
+                for key, vector in zip(keys, vectors):
+                    self.cache[key] = vector
+                    self.cache.move_to_end(key)
+                    futures.append(self.in_flight.pop(key))
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.stats_counter)
+            stats["size"] = len(self.cache)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["avg_batch"] = stats["batched_texts"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
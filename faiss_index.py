@@ -0,0 +1,200 @@
+"""
+faiss索引的创建、保存与加载
+除了精确检索的Flat外，还支持几种近似检索/量化索引，语料变大后检索耗时不再随条数线性增长：
+  flat      精确检索（基准）
+  ivf_flat  倒排分桶，只搜索最近的nprobe个桶
+  ivf_pq    倒排分桶 + 乘积量化，向量压缩为m个字节左右，内存占用最小
+  hnsw      分层小世界图，无需训练，检索快但占用内存较多
+  sq8       每维量化为8位，内存约为Flat的1/4，仍是精确遍历
+索引的类型与参数保存在索引文件旁的 <索引文件>.json 中，加载时据此恢复检索参数（nprobe、efSearch）
+"""
+import json
+import math
+import time
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8")
+
+# 各类型的默认参数，语料很小时会自动缩小到可训练的范围
+DEFAULT_PARAMS = {
+    "flat": {},
+    "ivf_flat": {"nlist": 100, "nprobe": 8},
+    "ivf_pq": {"nlist": 100, "nprobe": 8, "m": 16, "nbits": 8},
+    "hnsw": {"M": 32, "ef_construction": 200, "ef_search": 64},
+    "sq8": {},
+}
+
+
+def meta_path(index_path):
+    return index_path + ".json"
+
+
+def _params(index_type, n, dimension, params):
+    """合并默认参数，并根据语料条数修正：每个桶/码本至少需要若干条训练数据"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"未知的索引类型: {index_type}，可选 {INDEX_TYPES}")
+    merged = {**DEFAULT_PARAMS[index_type], **(params or {})}
+    if "nlist" in merged:
+        merged["nlist"] = max(1, min(merged["nlist"], n // 39 or 1))
+        merged["nprobe"] = max(1, min(merged["nprobe"], merged["nlist"]))
+    if "nbits" in merged:
+        # 码本大小为 2^nbits，训练数据不足时减小
+        merged["nbits"] = max(1, min(merged["nbits"], int(math.log2(max(2, n // 39)))))
+        if dimension % merged["m"]:
+            raise ValueError(f"ivf_pq 的 m={merged['m']} 必须能整除向量维数 {dimension}")
+    return merged
+
+
+def build_index(embeddings, index_type="flat", params=None):
+    """按类型创建索引并加入向量，返回 (index, 实际使用的参数)"""
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    n, dimension = embeddings.shape
+    params = _params(index_type, n, dimension, params)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, params["nlist"])
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, params["nlist"],
+                                 params["m"], params["nbits"])
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params["M"])
+        index.hnsw.efConstruction = params["ef_construction"]
+    else:
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    apply_search_params(index, index_type, params)
+    return index, params
+
+
+def apply_search_params(index, index_type, params):
+    """设置检索时的参数，这些参数不会写入索引文件，加载后需要重新设置"""
+    if index_type in ("ivf_flat", "ivf_pq"):
+        index.nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = params["ef_search"]
+
+
+def save_index(index, index_path, index_type, params, **extra):
+    """保存索引，并在旁边写入元数据"""
+    faiss.write_index(index, index_path)
+    meta = {
+        "index_type": index_type,
+        "params": params,
+        "dimension": index.d,
+        "ntotal": index.ntotal,
+        "metric": "l2",
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        **extra,
+    }
+    with open(meta_path(index_path), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_meta(index_path):
+    """读取索引元数据，旧的索引文件没有元数据时视为Flat"""
+    try:
+        with open(meta_path(index_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"index_type": "flat", "params": {}}
+
+
+def _mmap_flag(index_type):
+    """各类型索引可以内存映射的部分对应的读取标志，当前faiss不支持时返回None
+
+    IO_FLAG_MMAP 只映射IVF的倒排表（ivf_flat / ivf_pq）；
+    flat / sq8 的向量编码与 hnsw 底层的Flat存储需要 IO_FLAG_MMAP_IFC（faiss 1.8 起），hnsw 的图结构仍会读入内存
+    """
+    if index_type.startswith("ivf"):
+        return faiss.IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+
+
+def load_index(index_path, mmap=False):
+    """加载索引并恢复检索参数
+
+    mmap为True时以内存映射方式打开，不必一次读入整个文件，多个进程还可共享页缓存；
+    索引类型或faiss版本不支持内存映射时退回普通读取，并打印说明
+    """
+    meta = load_meta(index_path)
+    flag = _mmap_flag(meta["index_type"]) if mmap else None
+    if mmap and flag is None:
+        print(f"当前faiss不支持以内存映射方式打开 {meta['index_type']} 索引（需要 1.8 以上版本），改为普通读取")
+    if flag is not None:
+        try:
+            index = faiss.read_index(index_path, flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            print(f"索引 {index_path} 无法内存映射，改为普通读取: {e}")
+            index = faiss.read_index(index_path)
+    else:
+        index = faiss.read_index(index_path)
+    apply_search_params(index, meta["index_type"], meta["params"])
+    return index
+
+
+def _index_bytes(index):
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def benchmark(embeddings, queries, k=3, variants=None):
+    """以Flat的精确结果为准，比较各类型索引的 recall@k、单次检索延迟、创建耗时与大小
+
+    variants: [(index_type, params), ...]，默认每种类型使用默认参数
+    返回每种索引一行的字典列表
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    k = min(k, len(embeddings))
+    variants = variants or [(index_type, None) for index_type in INDEX_TYPES]
+
+    exact, _ = build_index(embeddings, "flat")
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for index_type, params in variants:
+        started = time.perf_counter()
+        index, used = build_index(embeddings, index_type, params)
+        build_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for query in queries:
+            # 逐条检索，与线上每轮一次检索的用法一致
+            index.search(query[None, :], k)
+        latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        _, found = index.search(queries, k)
+        hits = sum(len(set(row_found) & set(row_truth)) for row_found, row_truth in zip(found, truth))
+        report.append({
+            "index_type": index_type,
+            "params": used,
+            f"recall@{k}": hits / (len(queries) * k),
+            "latency_ms": latency_ms,
+            "build_seconds": build_seconds,
+            "size_mb": _index_bytes(index) / 1024 / 1024,
+        })
+    return report
+
+
+def format_report(report):
+    """把benchmark的结果排成表格文本"""
+    recall_key = next(key for key in report[0] if key.startswith("recall@"))
+    lines = [f"{'类型':<10}{recall_key:>10}{'延迟(ms)':>10}{'创建(s)':>10}{'大小(MB)':>10}  参数"]
+    for row in report:
+        lines.append(f"{row['index_type']:<10}{row[recall_key]:>10.3f}{row['latency_ms']:>10.3f}"
+                     f"{row['build_seconds']:>10.2f}{row['size_mb']:>10.2f}  {row['params']}")
+    return "\n".join(lines)
+
+
+def sample_queries(embeddings, count=200, noise=0.01, seed=0):
+    """没有真实查询时，从语料中抽样并加入少量噪声作为查询向量"""
+    rng = np.random.default_rng(seed)
+    picked = embeddings[rng.choice(len(embeddings), size=min(count, len(embeddings)), replace=False)]
+    scale = noise * float(np.linalg.norm(picked, axis=1).mean()) / math.sqrt(picked.shape[1])
+    return (picked + rng.normal(0, scale, picked.shape)).astype("float32")
@@ -2,11 +2,24 @@
 用于创建并储存faiss索引，主要目的是通过提前保存好的索引文件，减少发送信息后的等待时间
 主要思路是首先使用文本嵌入模型m3e-base将文本转为高维
 可以尝试仅搜索问句的数据，然后提取数据时提取包括答句和时间在内的所有数据传递给模型
+
+索引类型与参数在下方配置，可选 flat / ivf_flat / ivf_pq / hnsw / sq8（说明见 faiss_index.py）
+开启 run_benchmark 时，会以flat为基准输出各类型索引的 recall@k 与检索延迟，便于语料变大后选择索引
 """
 
 import json
-import faiss
 from sentence_transformers import SentenceTransformer
+import faiss_index
+
+# 索引配置
+index_path = "templates/index.faiss"  # 元数据保存在 templates/index.faiss.json
+index_type = "flat"  # 语料只有几千条以内时flat最准也足够快
+index_params = {}  # 覆盖默认参数，如 {"nlist": 256, "nprobe": 16} 或 {"M": 32, "ef_search": 128}
+
+# 对比测试配置
+run_benchmark = False
+benchmark_k = 3  # 与检索时的k一致
+benchmark_queries = 200  # 从语料中抽样作为查询的条数
 
 # 打开训练数据并读取
 with open("templates/train.json", "r", encoding="utf-8") as f:
@@ -28,12 +41,16 @@ for item in knowledge_data:
 # 将数据通过m3e-base模型转为高维向量
 doc_embeddings = embedding_model.encode(documents, show_progress_bar=True)
 
-# 获取转换后高维向量的维数
-dimension = doc_embeddings.shape[1]
+# 创建faiss索引并加入数据
+index, used_params = faiss_index.build_index(doc_embeddings, index_type, index_params)
+
+extra = {"model": "m3e-base", "source": "templates/train.json"}
+if run_benchmark:
+    queries = faiss_index.sample_queries(doc_embeddings, benchmark_queries)
+    report = faiss_index.benchmark(doc_embeddings, queries, k=benchmark_k)
+    print(faiss_index.format_report(report))
+    extra["benchmark"] = report
 
-# 创建faiss索引
-index = faiss.IndexFlatL2(dimension)
-# 将数据添加至faiss索引中
-index.add(doc_embeddings)
-# 保存索引
-faiss.write_index(index, "templates/index.faiss")
\ No newline at end of file
+# 保存索引与元数据
+meta = faiss_index.save_index(index, index_path, index_type, used_params, **extra)
+print(f"已保存 {index_type} 索引，共 {meta['ntotal']} 条，参数 {used_params}")
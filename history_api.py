@@ -0,0 +1,71 @@
+"""
+/get_chat_history 接口的公共逻辑：分页参数解析、ETag 协商与流式（可gzip压缩）的JSON输出
+响应体边序列化边发送，大量聊天记录不会在内存中拼成一个完整的字符串
+"""
+import json
+import zlib
+import hashlib
+from flask import Response
+
+# 每次yield的记录条数
+CHUNK_SIZE = 200
+
+
+def parse_history_args(args):
+    """从请求参数中读取 before / after / since / limit"""
+    query = {key: args.get(key) or None for key in ("before", "after", "since")}
+    limit = args.get("limit")
+    try:
+        query["limit"] = max(1, int(limit)) if limit else None
+    except ValueError:
+        query["limit"] = None
+    return query
+
+
+def make_etag(version, query):
+    """由记录版本与查询参数生成ETag，同样的数据与参数得到同样的ETag"""
+    raw = json.dumps([version, query], sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+def _iter_json(page, has_more, cursors):
+    """逐块生成 {"history": [...], "has_more": ..., "next_before": ..., "next_after": ...}"""
+    yield b'{"history": ['
+    for i in range(0, len(page), CHUNK_SIZE):
+        chunk = ", ".join(json.dumps(item, ensure_ascii=False) for item in page[i:i + CHUNK_SIZE])
+        yield ((", " if i else "") + chunk).encode("utf-8")
+    tail = {
+        "has_more": has_more,
+        # 客户端用这两个游标（"时间#序号"）继续翻页或拉取增量
+        "next_before": cursors[0],
+        "next_after": cursors[1],
+    }
+    yield ("], " + json.dumps(tail, ensure_ascii=False)[1:]).encode("utf-8")
+
+
+def _gzip(chunks):
+    """把字节块流式压缩为gzip格式"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def history_response(request, page, has_more, etag, cursors=(None, None)):
+    """根据请求头返回 304 或流式的聊天记录响应，cursors 为 page() 返回的第一条与最后一条的游标"""
+    if etag and etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = _iter_json(page, has_more, cursors)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = _gzip(body)
+        headers["Content-Encoding"] = "gzip"
+    response = Response(body, mimetype="application/json; charset=utf-8", headers=headers)
+    if etag:
+        response.set_etag(etag)
+    return response
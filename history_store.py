@@ -0,0 +1,502 @@
+"""
+聊天记录的追加式存储
+每条记录以一行JSON的形式追加到 history/<小时>.jsonl 中，由后台线程批量写入，不会阻塞流式回复
+系统提示词不会被保存；读取时同时兼容旧版整体保存的 .json 文件
+读取端由HistoryCache缓存解析结果，只重新解析新增或变化的文件
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import bisect
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson  # 可选，解析速度比标准库json快数倍
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def recover_tail(path):
+    """截掉文件末尾不完整的一行（进程崩溃时可能只写了一半），返回截掉的字节数"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        data = f.read()
+        if not data or data.endswith(b"\n"):
+            return 0
+        keep = data.rfind(b"\n") + 1
+        f.truncate(keep)
+    return len(data) - keep
+
+
+def read_jsonl(path):
+    """读取 .jsonl 文件，跳过无法解析的行（如被截断的最后一行）"""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def read_history_file(path):
+    """读取单个聊天记录文件，支持追加式的 .jsonl 与旧版的 .json"""
+    if path.endswith(".jsonl"):
+        records = read_jsonl(path)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+    return [item for item in records if item.get("role") != "system"]
+
+
+class HistoryWriter:
+    """后台批量追加写入聊天记录
+
+    fsync_policy:
+        "always"   每批写入后都调用fsync，断电也不丢数据
+        "interval" 距上次fsync超过fsync_interval秒才调用一次
+        "never"    只flush到操作系统，由系统决定何时落盘
+    """
+
+    def __init__(self, folder="history", fsync_policy="interval", fsync_interval=1.0, batch_interval=0.2):
+        if fsync_policy not in ("always", "interval", "never"):
+            raise ValueError(f"未知的fsync策略: {fsync_policy}")
+        self.folder = folder
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.batch_interval = batch_interval
+        self.queue = queue.Queue()
+        self.recovered = set()  # 本进程中已经检查过末尾的文件
+        self.last_fsync = 0.0
+        self.seq_lock = threading.Lock()
+        self.last_seq = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def append(self, record):
+        """提交一条记录，立即返回；系统提示词会被忽略
+
+        记录中没有 seq 时写入一个递增的序号（纳秒时间戳，重启后也不会回退），
+        同一秒内内容相同的两条记录（如连续两句“嗯。”）靠它区分，不会被当作重复
+        """
+        if record.get("role") == "system":
+            return
+        if "seq" not in record:
+            with self.seq_lock:
+                self.last_seq = max(time.time_ns(), self.last_seq + 1)
+                record["seq"] = self.last_seq
+        self.queue.put(dict(record))
+
+    def flush(self):
+        """等待已提交的记录全部写入文件"""
+        self.queue.join()
+
+    def _path_for(self, record):
+        """按记录时间所在的小时决定写入的文件（如：history/2025-10-20_14.jsonl）"""
+        try:
+            hour = datetime.strptime(record["time"], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d_%H")
+        except (KeyError, TypeError, ValueError):
+            hour = datetime.now().strftime("%Y-%m-%d_%H")
+        return os.path.join(self.folder, f"{hour}.jsonl")
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # 在短时间窗口内收集更多记录，合并为一次写入
+            deadline = time.monotonic() + self.batch_interval
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"保存聊天记录失败: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        os.makedirs(self.folder, exist_ok=True)
+        grouped = {}
+        for record in batch:
+            grouped.setdefault(self._path_for(record), []).append(record)
+
+        now = time.monotonic()
+        do_fsync = self.fsync_policy == "always" or (
+            self.fsync_policy == "interval" and now - self.last_fsync >= self.fsync_interval
+        )
+        for path, records in grouped.items():
+            if path not in self.recovered:
+                dropped = recover_tail(path)
+                if dropped:
+                    print(f"{path} 末尾有 {dropped} 字节不完整的记录，已截断")
+                self.recovered.add(path)
+            lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                if do_fsync:
+                    os.fsync(f.fileno())
+        if do_fsync:
+            self.last_fsync = now
+
+
+def _record_key(item):
+    """去重用的键：同一条记录可能出现在多个旧版 .json 文件中
+    新记录带有会话与写入序号，不同会话或同一秒内的相同发言不会被误判为重复
+    """
+    return (item.get("time"), item.get("role"), item.get("content"), item.get("session"), item.get("seq"))
+
+
+def _parse_file(path, offset=0):
+    """解析聊天记录文件，返回 (记录列表, 已解析到的字节位置)
+
+    .jsonl 文件从offset开始只解析完整的行，最后一行如果还没写完则留到下次
+    """
+    with open(path, "rb") as f:
+        if path.endswith(".jsonl"):
+            f.seek(offset)
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            records = []
+            for line in data[:end].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    records.append(_loads(line))
+                except ValueError:
+                    continue
+            return records, offset + end
+        data = f.read()
+    return _loads(data), len(data)
+
+
+class SortedHistory:
+    """按时间排序、去重的聊天记录集合，新记录通常直接追加到末尾"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.times = []  # 与items一一对应的时间，用于二分插入
+        self.items = []
+        self.seen = set()
+
+    def clear(self):
+        with self.lock:
+            self.times = []
+            self.items = []
+            self.seen = set()
+
+    def _insert(self, item):
+        """插入一条记录并保持按时间排序，通常是O(1)的追加"""
+        if item.get("role") == "system" or not item.get("time"):
+            return
+        key = _record_key(item)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        time_key = item["time"]
+        if not self.times or time_key >= self.times[-1]:
+            self.times.append(time_key)
+            self.items.append(item)
+        else:
+            position = bisect.bisect_right(self.times, time_key)
+            self.times.insert(position, time_key)
+            self.items.insert(position, item)
+
+    def add(self, record):
+        """加入一条记录"""
+        with self.lock:
+            self._insert(dict(record))
+
+    def extend(self, records):
+        """加入多条记录，已存在的会被忽略"""
+        with self.lock:
+            for record in records:
+                self._insert(dict(record))
+
+    def _position(self, cursor, after):
+        """游标对应的切片位置；after为True时返回游标之后第一条的位置，否则返回游标本身的位置
+
+        游标为 "时间#序号"，序号是该记录在同一秒内的先后次序，同一秒有多条记录时也能精确定位
+        只有时间（旧版客户端）时按整秒比较
+        """
+        time_key, _, ordinal = cursor.partition("#")
+        lo = bisect.bisect_left(self.times, time_key)
+        hi = bisect.bisect_right(self.times, time_key, lo=lo)
+        if not ordinal.isdigit():
+            return hi if after else lo
+        position = lo + int(ordinal)
+        if position >= hi:
+            return hi
+        return position + 1 if after else position
+
+    def _cursor(self, position):
+        time_key = self.times[position]
+        return f"{time_key}#{position - bisect.bisect_left(self.times, time_key, hi=position)}"
+
+    def page(self, before=None, after=None, since=None, limit=None):
+        """按游标分页查询，返回 (记录列表, 是否还有更多, 第一条的游标, 最后一条的游标)
+
+        before: 返回游标之前的最近limit条（向前翻页）
+        after:  返回游标之后的最早limit条（向后翻页）
+        since:  增量模式，返回游标之后的全部新记录（limit可选）
+        都不指定时返回最近的limit条，limit为空则返回全部
+        游标可以是上次返回的 "时间#序号"，也可以只是时间
+        """
+        with self.lock:
+            start = 0
+            end = len(self.items)
+            if after is not None or since is not None:
+                start = max(self._position(c, after=True) for c in (after, since) if c is not None)
+            if before is not None:
+                end = max(start, self._position(before, after=False))
+            has_more = limit is not None and end - start > limit
+            if has_more:
+                if after is not None or since is not None:
+                    end = start + limit
+                else:
+                    start = end - limit
+            if start >= end:
+                return [], has_more, None, None
+            return self.items[start:end], has_more, self._cursor(start), self._cursor(end - 1)
+
+    def query(self, before=None, after=None, since=None, limit=None):
+        """同 page()，只返回 (记录列表, 是否还有更多)"""
+        items, has_more, _, _ = self.page(before, after, since, limit)
+        return items, has_more
+
+    def recent(self, session_id, limit):
+        """从最新的记录往前找，返回属于该会话的最近limit条（没有会话字段的旧记录视为所有会话共有）"""
+        with self.lock:
+            found = []
+            for item in reversed(self.items):
+                if item.get("session", session_id) == session_id:
+                    found.append(item)
+                    if len(found) >= limit:
+                        break
+            found.reverse()
+            return found
+
+    def last_time(self):
+        with self.lock:
+            return self.times[-1] if self.times else None
+
+    def last_cursor(self):
+        """最后一条记录的游标，用于增量同步的since"""
+        with self.lock:
+            return self._cursor(len(self.times) - 1) if self.times else None
+
+    def etag(self):
+        """当前内容的版本标识，记录有变化时随之改变"""
+        with self.lock:
+            return f"{len(self.items)}-{self.last_time() or ''}"
+
+    def get(self):
+        """返回按时间排序的全部聊天记录（副本）"""
+        with self.lock:
+            return list(self.items)
+
+
+class HistoryCache(SortedHistory):
+    """进程内的聊天记录缓存
+
+    按文件的mtime/大小判断是否需要重新解析，.jsonl 文件只解析新追加的部分
+    每个文件的解析结果单独保存在 history/.cache/<文件名>.json 中，重启后也不必重新读取全部文件
+    缓存由后台线程定期写入，只重写有变化的文件，不占用读取请求的线程，也不持有缓存的锁
+    """
+
+    def __init__(self, folder="history", cache_name=".cache", workers=4,
+                 refresh_interval=1.0, save_interval=60.0):
+        super().__init__()
+        self.folder = folder
+        self.cache_folder = os.path.join(folder, cache_name)
+        self.workers = workers
+        self.refresh_interval = refresh_interval
+        self.save_interval = save_interval
+        self.files = {}  # 文件名 -> {"mtime_ns", "size", "offset", "records"}
+        self.last_refresh = 0.0
+        self.dirty = set()  # 解析结果有变化、尚未写入缓存的文件名
+        self.removed = set()  # 已被删除、需要删掉缓存的文件名
+        self.save_lock = threading.Lock()  # 后台线程与退出时的保存不同时写入
+        self._load_cache()
+        self._rebuild()
+        threading.Thread(target=self._save_loop, name="history-cache", daemon=True).start()
+        atexit.register(self.save_cache)
+
+    def _cache_path(self, name):
+        return os.path.join(self.cache_folder, name + ".json")
+
+    def _load_cache(self):
+        self.files = {}
+        try:
+            entries = [e for e in os.scandir(self.cache_folder) if e.is_file() and e.name.endswith(".json")]
+        except FileNotFoundError:
+            entries = []
+        for e in entries:
+            try:
+                with open(e.path, "rb") as f:
+                    entry = _loads(f.read())
+                self.files[e.name[:-len(".json")]] = entry
+            except (OSError, ValueError):
+                continue  # 损坏的缓存忽略，对应文件会被重新解析
+        # 旧版把全部解析结果放在一个manifest中，已不再使用
+        legacy = os.path.join(self.folder, ".manifest.json")
+        if os.path.exists(legacy):
+            try:
+                os.remove(legacy)
+            except OSError:
+                pass
+
+    def _save_loop(self):
+        while True:
+            time.sleep(self.save_interval)
+            self.save_cache()
+
+    def save_cache(self):
+        """把有变化的文件的解析结果写入缓存，先写临时文件再替换，避免写到一半时崩溃"""
+        with self.lock:
+            # 锁内只复制有变化的文件的记录列表，写文件在锁外进行
+            jobs = {name: dict(self.files[name], records=list(self.files[name]["records"]))
+                    for name in self.dirty if name in self.files}
+            removed = set(self.removed)
+            self.dirty.clear()
+            self.removed.clear()
+        if not (jobs or removed):
+            return
+        with self.save_lock:
+            failed = set()
+            try:
+                os.makedirs(self.cache_folder, exist_ok=True)
+            except OSError as e:
+                print(f"保存聊天记录缓存失败: {e}")
+                failed = set(jobs)
+                jobs = {}
+            for name, entry in jobs.items():
+                try:
+                    tmp_path = self._cache_path(name) + ".tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        json.dump(entry, f, ensure_ascii=False)
+                    os.replace(tmp_path, self._cache_path(name))
+                except OSError as e:
+                    print(f"保存聊天记录缓存 {name} 失败: {e}")
+                    failed.add(name)
+            for name in removed:
+                try:
+                    os.remove(self._cache_path(name))
+                except OSError:
+                    pass
+        if failed:
+            with self.lock:
+                self.dirty.update(failed)  # 下次再试
+
+    def _rebuild(self):
+        """根据各文件的解析结果重建合并后的记录"""
+        self.clear()
+        records = []
+        for name in sorted(self.files):
+            records.extend(self.files[name]["records"])
+        records.sort(key=lambda item: item.get("time") or "")
+        for item in records:
+            self._insert(item)
+
+    def refresh(self, force=False):
+        """检查目录变化，只解析新增或变化的文件"""
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+            try:
+                entries = [e for e in os.scandir(self.folder) if e.is_file() and not e.name.startswith(".")]
+            except FileNotFoundError:
+                entries = []
+
+            current = {e.name: e.stat() for e in entries}
+            removed = [name for name in self.files if name not in current]
+            full_parse = []
+            appended = []
+            for name, st in current.items():
+                entry = self.files.get(name)
+                if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                    continue
+                if entry and name.endswith(".jsonl") and st.st_size >= entry["offset"]:
+                    appended.append((name, st))
+                else:
+                    full_parse.append((name, st))
+
+            if not (removed or full_parse or appended):
+                return
+
+            for name in removed:
+                del self.files[name]
+                self.dirty.discard(name)
+                self.removed.add(name)
+
+            appended_names = {name for name, _ in appended}
+
+            def parse(job):
+                name, st = job
+                entry = self.files.get(name)
+                offset = entry["offset"] if name in appended_names else 0
+                try:
+                    records, new_offset = _parse_file(os.path.join(self.folder, name), offset)
+                except (OSError, ValueError) as e:
+                    print(f"Error reading file {name}: {e}")
+                    return name, st, [], offset
+                return name, st, [r for r in records if r.get("role") != "system"], new_offset
+
+            jobs = full_parse + appended
+            if len(jobs) > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results = list(executor.map(parse, jobs))
+            else:
+                results = [parse(job) for job in jobs]
+
+            new_records = []
+            for name, st, records, offset in results:
+                if name in appended_names:
+                    self.files[name]["records"].extend(records)
+                    new_records.extend(records)
+                else:
+                    self.files[name] = {"records": records}
+                self.files[name].update({"mtime_ns": st.st_mtime_ns, "size": st.st_size, "offset": offset})
+                self.dirty.add(name)
+                self.removed.discard(name)
+
+            if removed or full_parse:
+                self._rebuild()
+            else:
+                for item in new_records:
+                    self._insert(item)
+
+    def page(self, before=None, after=None, since=None, limit=None):
+        self.refresh()
+        return super().page(before, after, since, limit)
+
+    def recent(self, session_id, limit):
+        self.refresh()
+        return super().recent(session_id, limit)
+
+    def etag(self):
+        self.refresh()
+        return super().etag()
+
+    def get(self):
+        self.refresh()
+        return super().get()
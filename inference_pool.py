@@ -0,0 +1,81 @@
+"""
+固定大小的推理线程池
+本地只有一个Ollama/GPU，同时跑太多生成只会互相抢占、全部变慢
+超过线程数的任务进入有界队列排队，队列满时直接拒绝，让调用方尽快得到反馈
+"""
+import time
+import queue
+import itertools
+import threading
+
+
+class InferencePool:
+    """有界队列 + 固定数量的工作线程
+
+    ordering 为 "fifo" 时按提交顺序执行；为 "priority" 时priority小的先执行，相同优先级按提交顺序
+    """
+
+    def __init__(self, workers=1, max_queue=8, ordering="fifo"):
+        if ordering not in ("fifo", "priority"):
+            raise ValueError(f"未知的排队方式: {ordering}")
+        self.ordering = ordering
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.started = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"inference-{i}", daemon=True).start()
+
+    def submit(self, task_id, fn, *args, priority=0):
+        """提交任务，返回排队位置；队列已满时返回None"""
+        if self.ordering == "fifo":
+            priority = 0
+        item = (priority, next(self.sequence), time.monotonic(), task_id, fn, args)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return None
+        return self.queue.qsize()
+
+    def depth(self):
+        """排队中与执行中的任务总数"""
+        with self.lock:
+            return self.queue.qsize() + self.running
+
+    def _run(self):
+        while True:
+            _, _, enqueued_at, task_id, fn, args = self.queue.get()
+            wait = time.monotonic() - enqueued_at
+            with self.lock:
+                self.running += 1
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            print(f"任务 {task_id} 排队 {wait:.2f} 秒后开始执行")
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"任务 {task_id} 执行出错: {e}")
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                self.queue.task_done()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait": self.total_wait / self.started if self.started else 0.0,
+                "max_wait": self.max_wait,
+            }
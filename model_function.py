@@ -1,56 +1,105 @@
-
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-from sentence_transformers import SentenceTransformer
-import torch
-import faiss
+import threading
 import json
+from startup import Readiness, load_in_background
+
+# 模型与索引在第一次调用时加载（或调用 preload() 提前在后台加载），导入本模块不再需要等待
+readiness = Readiness()
+load_lock = threading.Lock()
+embeddings = documents = index = None
+model_name = tokenizer = generator = answer_cache = None
 
-#初始化嵌入模型和 FAISS 索引
-#导入你自己的模型
-embedding_model = SentenceTransformer("models/m3e-base")
-
-# 加载知识库并构建文档列表
-with open("templates/train.json", "r", encoding="utf-8") as f:
-    knowledge_data = json.load(f)
-documents = [
-    f"问题：{item.get('instruction', '')}\n回答：{item.get('output', '')}"
-    for item in knowledge_data
-]
-
-# 导入FAISS索引
-index = faiss.read_index("templates/index.faiss")
-#加载模型和分词器
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_compute_dtype=torch.float16,
-    bnb_4bit_use_double_quant=True,
-    bnb_4bit_quant_type="nf4",
+# 语义回答缓存（可选）：与train.json中的问题或之前的问题足够相近时直接返回保存的回答，不调用模型
+answer_cache_enabled = False
+answer_cache_threshold = 0.08  # 余弦距离阈值，越小越严格
+answer_cache_ttl = 3600  # 模型生成的回答在缓存中的有效期（秒）
+answer_cache_size = 512  # 模型生成的回答最多缓存的条数
+
+# 系统提示词中固定不变的开头部分，放在最前面以便复用KV缓存
+STATIC_PROMPT = (
+    "请你根据以下提供的知识内容回答用户的问题，回答时请尽量基于这些内容，并避免编造。\n"
 )
 
-model_path = f'models/Qwen3-06B'
-model_name = AutoModelForCausalLM.from_pretrained(
-    model_path,
-    quantization_config=bnb_config,
-    device_map="auto",
-).to("cuda")
 
-tokenizer = AutoTokenizer.from_pretrained(model_path)
+def load():
+    """加载嵌入模型、FAISS索引、模型和分词器，只执行一次"""
+    global embeddings, documents, index, model_name, tokenizer, generator, answer_cache
+    with load_lock:
+        if model_name is not None:
+            return
+        with readiness.profile("导入 torch / transformers / sentence_transformers"):
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+            from sentence_transformers import SentenceTransformer
+            import faiss_index
+            from embedding_service import EmbeddingService
+            from batch_generator import BatchGenerator
+
+        #初始化嵌入模型和 FAISS 索引
+        #导入你自己的模型
+        with readiness.profile("加载嵌入模型"):
+            embeddings = EmbeddingService(SentenceTransformer("models/m3e-base"))  # 缓存重复问题的向量，并发请求合并编码
+
+        # 加载知识库并构建文档列表
+        with open("templates/train.json", "r", encoding="utf-8") as f:
+            knowledge_data = json.load(f)
+        documents = [
+            f"问题：{item.get('instruction', '')}\n回答：{item.get('output', '')}"
+            for item in knowledge_data
+        ]
+
+        if answer_cache_enabled:
+            from answer_cache import AnswerCache
+            answer_cache = AnswerCache(answer_cache_threshold, answer_cache_ttl, answer_cache_size)
+            answer_cache.add_curated([(item.get("instruction"), item.get("output")) for item in knowledge_data],
+                                     embeddings.model.encode)
+
+        # 以内存映射方式导入FAISS索引（按元数据恢复nprobe等检索参数）
+        with readiness.profile("加载FAISS索引"):
+            index = faiss_index.load_index("templates/index.faiss", mmap=True)
+        #加载模型和分词器
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+        )
+
+        model_path = f'models/Qwen3-06B'
+        with readiness.profile("加载模型"):
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            model_name = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                quantization_config=bnb_config,
+                device_map="auto",
+            ).to("cuda")
+            generator = BatchGenerator(model_name, tokenizer)  # 并发请求合并为批量生成
+
+
+def preload():
+    """在后台线程中提前加载，readiness 反映加载进度"""
+    return load_in_background(readiness, "model", load)
+
+
 def chat_completions_model( messages, max_tokens=500, temperature=0.1):
     '''
     使用本地LLM结合RAG检索进行问答
     '''
+    load()
     #构造RAG检索
     if isinstance(messages, str):
         messages = [{"role": "user", "content": messages}]
     user_question = messages[-1]["content"]
-    question_embedding = embedding_model.encode([user_question])
+    question_embedding = embeddings.encode([user_question])
+    if answer_cache is not None:
+        cached = answer_cache.lookup(question_embedding[0])
+        if cached:
+            return cached
     D, I = index.search(question_embedding, k=3)
     related_docs = "\n---\n".join([documents[i] for i in I[0]])
     rag_prefix = (
-        "请你根据以下提供的知识内容回答用户的问题。\n"
+        f"{STATIC_PROMPT}"
         "知识来源如下（可能不完全匹配，但请尽可能参考）：\n"
-        f"{related_docs}\n"
-        "回答时请尽量基于上述内容，并避免编造。\n\n"
+        f"{related_docs}\n\n"
     )
     system_prompt = {
         "role": "system",
@@ -59,29 +108,19 @@ def chat_completions_model( messages, max_tokens=500, temperature=0.1):
 
     full_conversation = [system_prompt] + messages
 
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        tokenizer.pad_token_id = tokenizer.eos_token_id
-
     formatted_input = tokenizer.apply_chat_template(
         full_conversation,
         tokenize=False,
         add_generation_prompt=True,
         enable_thinking=False
     )
-    inputs = tokenizer(formatted_input, return_tensors='pt').to('cuda')
-
-    input_tokens = inputs.input_ids.shape[1]
 
-    outputs = model_name.generate(
-        inputs.input_ids,
-        max_length=input_tokens + max_tokens,
-        temperature=temperature,
-        pad_token_id=tokenizer.pad_token_id,
-        eos_token_id=tokenizer.eos_token_id,
-    )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    #进行推理：与同时到达的其他请求合并为一批生成，返回的只有新生成的文本
+    prefix = formatted_input[:formatted_input.find(STATIC_PROMPT) + len(STATIC_PROMPT)]
+    response = generator.generate(formatted_input, max_tokens=max_tokens, temperature=temperature, prefix=prefix)
 
+    if answer_cache is not None and response.strip():
+        answer_cache.add(user_question, question_embedding[0], response.strip())
     return response
 
 #测试
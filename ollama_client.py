@@ -0,0 +1,137 @@
+"""
+与Ollama通信的客户端，server_本地.py 与 server_公网.py 共用
+使用 /api/chat 发送结构化的消息列表：系统提示词作为固定的第一条消息，
+只要它不变，Ollama 就能复用已经预填充过的KV缓存，每轮只需预填充新增的消息
+"stream": True 时返回NDJSON，每一行是一个包含部分回复的JSON对象，最后一行带 "done": true
+"""
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# 模型在Ollama中保持加载的时间，期间系统提示词的KV缓存也会一直保留
+KEEP_ALIVE = "30m"
+
+
+def _is_connect_error(e):
+    """只有建立连接阶段的失败才可以安全重试，此时Ollama还没有收到请求"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class OllamaClient:
+    """带连接池的Ollama客户端
+
+    所有请求共用一个Session，TCP连接保持复用
+    连接池满时不阻塞等待（requests 不支持设置取连接的超时，阻塞时可能永远等下去），
+    临时新建连接，用完后关闭，池中最多保留 pool_size 个空闲连接
+    连接阶段与读取阶段分别设置超时，Ollama卡死时不会永久占用线程
+    只有连接失败才会重试（带随机抖动的指数退避），已经开始生成的请求不会重复发送
+    """
+
+    def __init__(self, url, model, pool_size=4, connect_timeout=3.0, read_timeout=120.0,
+                 retries=2, backoff=0.5, keep_alive=KEEP_ALIVE):
+        self.url = url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "in_flight": 0}
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _payload(self, messages, temperature, stream, **options):
+        return {
+            "model": f"{self.model}",
+            "messages": messages,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": {"temperature": temperature, **options}
+        }
+
+    def _post(self, payload, stream=False):
+        """发送请求，连接失败时重试，返回已检查状态码的响应"""
+        self._count("requests")
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout, stream=stream)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries or not _is_connect_error(e):
+                    self._count("errors")
+                    raise
+                self._count("retries")
+                time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            except requests.exceptions.RequestException:
+                self._count("errors")
+                raise
+
+    def chat(self, messages, temperature=0.9):
+        """一次性请求Ollama，返回完整回复"""
+        self._count("in_flight")
+        try:
+            response = self._post(self._payload(messages, temperature, False))
+            return response.json().get("message", {}).get("content", "")
+        finally:
+            self._count("in_flight", -1)
+
+    def stream_chat(self, messages, temperature=0.9):
+        """以流式方式请求Ollama，逐个yield模型生成的文本片段"""
+        self._count("in_flight")
+        try:
+            # with 保证中途退出时连接也会归还连接池
+            with self._post(self._payload(messages, temperature, True), stream=True) as response:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    text = chunk.get("message", {}).get("content", "")
+                    if text:
+                        yield text
+                    if chunk.get("done"):
+                        break
+        finally:
+            self._count("in_flight", -1)
+
+    def warm_up(self, system_prompt):
+        """只发送系统提示词并生成1个token，让Ollama提前完成系统提示词的预填充"""
+        try:
+            messages = [{"role": "system", "content": system_prompt}]
+            self._post(self._payload(messages, 0, False, num_predict=1)).close()
+            print("系统提示词预填充完成")
+        except requests.exceptions.RequestException as e:
+            print(f"系统提示词预填充失败: {e}")
+
+    def pool_stats(self):
+        """返回请求计数与连接池状态"""
+        with self.lock:
+            stats = dict(self.stats)
+        pools = []
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[key]
+            pools.append({
+                "host": f"{pool.host}:{pool.port}",
+                "connections_created": pool.num_connections,
+                "requests_sent": pool.num_requests,
+                # 队列中的None是尚未建立连接的空位
+                "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0,
+            })
+        stats["pools"] = pools
+        return stats
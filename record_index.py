@@ -0,0 +1,208 @@
+"""
+聊天记录（ji_lu）的向量索引
+每条记录有一个递增的ID，FAISS索引使用 IndexIDMap2，检索得到的就是记录ID，与记录一一对应
+每轮对话只需要：向 records.jsonl 追加一行、编码一次、add_with_ids，耗时与已有记录数无关
+索引定期在后台保存快照；启动时加载快照，再补上快照之后追加的记录
+删除的记录以墓碑行记录，墓碑占比过高时后台重写 records.jsonl 并保存新的快照
+
+目录结构：
+  records.jsonl   每行一条记录 {"id": ..., "instruction": ..., "time": ..., "output": ...}，删除为 {"id": ..., "deleted": true}
+  index.faiss     索引快照
+  snapshot.json   快照包含的最大记录ID
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import faiss
+import numpy as np
+
+from history_store import recover_tail
+
+
+def record_text(record):
+    """记录转为用于向量化与提示词的文本"""
+    return f"问题：{record.get('instruction', '')}\n时间：{record.get('time', '')}\n回答：{record.get('output', '')}"
+
+
+class RecordIndex:
+    """ID对齐的聊天记录向量索引
+
+    embed(texts) 返回与 texts 对应的向量矩阵
+    legacy_path 为旧版的 ji_lu.json，目录中还没有记录时导入一次
+    """
+
+    def __init__(self, folder, embed, legacy_path=None, snapshot_interval=60.0, compact_ratio=0.2):
+        self.folder = folder
+        self.embed = embed
+        self.records_path = os.path.join(folder, "records.jsonl")
+        self.index_path = os.path.join(folder, "index.faiss")
+        self.snapshot_path = os.path.join(folder, "snapshot.json")
+        self.snapshot_interval = snapshot_interval
+        self.compact_ratio = compact_ratio
+        self.lock = threading.RLock()
+        self.records = {}  # id -> 记录
+        self.index = None
+        self.next_id = 0
+        self.tombstones = 0  # records.jsonl 中的墓碑行数
+        self.dirty = False  # 有快照之后的改动
+        os.makedirs(folder, exist_ok=True)
+        self._load(legacy_path)
+        threading.Thread(target=self._maintain, name="record-index", daemon=True).start()
+        atexit.register(self.snapshot)
+
+    def _new_index(self, dimension):
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+    def _add_vectors(self, ids, texts):
+        vectors = np.ascontiguousarray(self.embed(texts), dtype="float32")
+        if self.index is None:
+            self.index = self._new_index(vectors.shape[1])
+        self.index.add_with_ids(vectors, np.asarray(ids, dtype="int64"))
+
+    def _load(self, legacy_path):
+        snapshot_id = -1
+        if os.path.exists(self.index_path) and os.path.exists(self.snapshot_path):
+            self.index = faiss.read_index(self.index_path)
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot_id = json.load(f)["last_id"]
+
+        if not os.path.exists(self.records_path):
+            self._import_legacy(legacy_path)
+            return
+
+        # 截掉写到一半中断的最后一行，之后追加的记录才不会接在残行后面
+        dropped = recover_tail(self.records_path)
+        if dropped:
+            print(f"{self.records_path} 末尾有 {dropped} 字节不完整的记录，已截断")
+
+        # 重放记录文件：快照之后追加的记录需要重新编码，删除的记录从索引中移除
+        missing = []
+        skipped = 0
+        with open(self.records_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    record_id = int(entry["id"])
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1  # 损坏的行跳过，不影响其余记录的加载
+                    continue
+                self.next_id = max(self.next_id, record_id + 1)
+                if entry.get("deleted"):
+                    self.tombstones += 1
+                    self.records.pop(record_id, None)
+                    continue
+                self.records[record_id] = entry
+                if record_id > snapshot_id:
+                    missing.append(record_id)
+        if missing:
+            missing = [record_id for record_id in missing if record_id in self.records]
+            self._add_vectors(missing, [record_text(self.records[i]) for i in missing])
+            self.dirty = True
+        removed = [record_id for record_id in range(snapshot_id + 1) if record_id not in self.records]
+        if removed and self.index is not None:
+            self.index.remove_ids(np.asarray(removed, dtype="int64"))
+        print(f"聊天记录索引已加载，共 {len(self.records)} 条，补充编码 {len(missing)} 条"
+              + (f"，跳过 {skipped} 行损坏的记录" if skipped else ""))
+
+    def _import_legacy(self, legacy_path):
+        """从旧版的 ji_lu.json 一次性导入"""
+        legacy = []
+        if legacy_path and os.path.exists(legacy_path):
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                try:
+                    legacy = json.load(f)
+                except json.JSONDecodeError:
+                    legacy = []
+        with open(self.records_path, "w", encoding="utf-8") as f:
+            for record_id, item in enumerate(legacy):
+                entry = {"id": record_id, **item}
+                self.records[record_id] = entry
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.next_id = len(legacy)
+        if legacy:
+            self._add_vectors(list(self.records), [record_text(r) for r in self.records.values()])
+            self.snapshot(force=True)
+            print(f"已从 {legacy_path} 导入 {len(legacy)} 条聊天记录")
+
+    def add(self, record):
+        """追加一条记录并加入索引，返回记录ID"""
+        with self.lock:
+            record_id = self.next_id
+            self.next_id += 1
+            entry = {"id": record_id, **record}
+            with open(self.records_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.records[record_id] = entry
+            self._add_vectors([record_id], [record_text(entry)])
+            self.dirty = True
+            return record_id
+
+    def remove(self, record_ids):
+        """删除记录，索引中立即移除，记录文件中留下墓碑等待压缩"""
+        with self.lock:
+            record_ids = [record_id for record_id in record_ids if record_id in self.records]
+            if not record_ids:
+                return
+            with open(self.records_path, "a", encoding="utf-8") as f:
+                for record_id in record_ids:
+                    del self.records[record_id]
+                    f.write(json.dumps({"id": record_id, "deleted": True}) + "\n")
+            self.tombstones += len(record_ids)
+            self.index.remove_ids(np.asarray(record_ids, dtype="int64"))
+            self.dirty = True
+
+    def search(self, vectors, k=3):
+        """按查询向量检索，返回最相近的记录列表（按距离从近到远）"""
+        with self.lock:
+            if self.index is None or not self.index.ntotal:
+                return []
+            _, ids = self.index.search(np.ascontiguousarray(vectors, dtype="float32"), k)
+            return [self.records[i] for i in ids[0] if i in self.records]
+
+    def snapshot(self, force=False):
+        """保存索引快照，先写临时文件再替换，中途退出也不会损坏旧快照"""
+        with self.lock:
+            if self.index is None or not (self.dirty or force):
+                return
+            tmp = self.index_path + ".tmp"
+            faiss.write_index(self.index, tmp)
+            os.replace(tmp, self.index_path)
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"last_id": self.next_id - 1, "count": len(self.records)}, f)
+            os.replace(tmp, self.snapshot_path)
+            self.dirty = False
+
+    def compact(self):
+        """去掉记录文件中的墓碑与已删除的记录"""
+        with self.lock:
+            tmp = self.records_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for record_id in sorted(self.records):
+                    f.write(json.dumps(self.records[record_id], ensure_ascii=False) + "\n")
+            os.replace(tmp, self.records_path)
+            self.tombstones = 0
+            self.snapshot(force=True)
+
+    def _maintain(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                total = len(self.records) + self.tombstones
+                if self.tombstones and self.tombstones >= total * self.compact_ratio:
+                    self.compact()
+                else:
+                    self.snapshot()
+            except Exception as e:
+                print(f"聊天记录索引维护失败: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "records": len(self.records),
+                "indexed": self.index.ntotal if self.index is not None else 0,
+                "tombstones": self.tombstones,
+                "dirty": self.dirty,
+            }
@@ -0,0 +1,60 @@
+"""
+增量分句器：把模型逐token输出的文本切分成完整的句子
+每当一句话结束（句末标点及其后的右引号/右括号都已到达）就立即吐出，不必等待整段回复生成完毕
+"""
+
+# 句末标点
+SENTENCE_ENDINGS = "。！？!?…"
+# 可以紧跟在句末标点后面的右引号/右括号，属于同一句话
+CLOSING_MARKS = "”’」』）》】\"')"
+
+
+class SentenceSegmenter:
+    """增量分句器，feed()传入新到达的文本片段，返回其中已经完整的句子"""
+
+    def __init__(self, endings=SENTENCE_ENDINGS, closers=CLOSING_MARKS):
+        self.endings = endings
+        self.closers = closers
+        self.buffer = ""
+
+    def feed(self, text):
+        """追加文本片段，返回新完成的句子列表"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        i = 0
+        length = len(self.buffer)
+        while i < length:
+            char = self.buffer[i]
+            if char == "\n":
+                sentences.append(self.buffer[start:i])
+                start = i + 1
+            elif char in self.endings:
+                # 吞掉连续的句末标点（如“……”、“？！”）以及其后的右引号
+                end = i + 1
+                while end < length and self.buffer[end] in self.endings:
+                    end += 1
+                while end < length and self.buffer[end] in self.closers:
+                    end += 1
+                if end >= length:
+                    # 后面可能还有标点或引号没到，等下一个片段再判断
+                    break
+                sentences.append(self.buffer[start:end])
+                start = end
+                i = end
+                continue
+            i += 1
+        self.buffer = self.buffer[start:]
+        return [s.strip() for s in sentences if s.strip()]
+
+    def flush(self):
+        """生成结束时调用，返回缓冲区中剩余的内容（可能是没有句末标点的半句话）"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+
+def split_sentences(text):
+    """一次性把完整文本切分为句子列表"""
+    segmenter = SentenceSegmenter()
+    return segmenter.feed(text) + segmenter.flush()
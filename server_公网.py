@@ -1,13 +1,18 @@
-import os
-import json
-import faiss
-import requests
 import socketio
+import time
 import threading
 from datetime import datetime
+from ollama_client import OllamaClient
+from sentence_segmenter import SentenceSegmenter
+from history_store import HistoryWriter, HistoryCache
+from context_builder import ContextBuilder
+from session_store import SessionStore, DEFAULT_SESSION
+from inference_pool import InferencePool
+import wire_codec
+from chat_config import LiveConfig, make_system_prompt
 
 # 基本配置
-url = "http://localhost:11434/api/generate"  # ollama的url
+url = "http://localhost:11434/api/chat"  # ollama的url（/api/chat可复用系统提示词的KV缓存）
 model_name_path = "config/模型名称.txt"  # 模型名称
 
 # 文件路径配置
@@ -17,143 +22,169 @@ worldview_path = "config/世界观.txt"  # 世界观位置（如有额外设置
 # 服务器配置
 token_path = "config/token.txt"
 server_path_path = "config/公网地址.txt"  # 服务器地址（改为自己的）
-# 加载数据
-with open(model_name_path, "r", encoding='utf-8') as file:
-    model_name = file.read()  # 加载模型名称
 
-with open(character_setting_path, "r", encoding='utf-8') as file:
-    character_setting = file.read()  # 加载人设
+# 聊天记录配置
+history_fsync = "interval"  # 落盘策略：always（每批都fsync）/ interval（每秒最多一次）/ never（交给系统）
 
-with open(worldview_path, "r", encoding='utf-8') as file:
-    worldview = file.read()  # 加载世界观
+# 上下文配置
+context_token_budget = 6000  # 每轮发送给模型的提示词token预算，超出时丢弃最早的聊天记录
+history_format = "compact"  # 聊天记录格式：messages（逐条消息）/ compact（每条一行的紧凑文本，省token）
+report_history_tokens = False  # 每轮打印聊天记录在原格式与紧凑格式下的token估算（每轮要多渲染、统计三遍，仅调试时开启）
 
-with open(token_path, "r", encoding='utf-8') as file:
-    token = file.read()  # 加载token
+# 会话配置
+session_window = 40  # 每个会话在内存中保留的最近对话条数
+max_sessions = 64  # 内存中最多保留的会话数
+max_session_chars = 200000  # 所有会话在内存中的总字数上限，超出时淘汰最久未使用的会话
 
-with open(server_path_path, "r", encoding='utf-8') as file:
-    server_path = file.read()  # 加载公网地址
+# 推理并发配置
+inference_workers = 1  # 同时进行的生成数，单卡通常1~2最快
+inference_queue_size = 8  # 排队上限，超出时直接拒绝
+inference_ordering = "fifo"  # fifo：按到达顺序；priority：按请求中的priority字段，小的优先
+status_interval = 5  # 向转发服务器上报队列深度的间隔（秒），转发服务器据此决定是否接收新请求
+
+
+def derive_config(values):
+    """由人设与世界观生成系统提示词；固定的人设与规范部分始终保留，聊天记录按预算从最近的开始填充"""
+    system_prompt = make_system_prompt(values["worldview"], values["character_setting"], history_format)
+    return {"system_prompt": system_prompt,
+            "context_builder": ContextBuilder(system_prompt, token_budget=context_token_budget,
+                                              history_format=history_format)}
+
+
+# 加载数据：模型名称、人设、世界观、token、公网地址，文件修改后自动重新加载，无需重启
+config = LiveConfig({
+    "model_name": model_name_path,
+    "character_setting": character_setting_path,
+    "worldview": worldview_path,
+    "token": token_path,
+    "server_path": server_path_path,
+}, derive=derive_config)
+
+ollama = OllamaClient(url, config["model_name"])  # 共用的连接池客户端
 
 history_folder = "history"  # 聊天记录存储的文件夹
+history_cache = HistoryCache(history_folder)  # 只重新解析新增或变化的文件
+
+
 def get_history():
-    # 获取历史聊天记录的文件列表
-    files = os.listdir(history_folder)
-    all_history = {}
+    """获取按时间排序的全部历史聊天记录"""
+    return history_cache.get()
 
-    for file_name in files:
-        file_path = os.path.join(history_folder, file_name)
 
-        if not os.path.isfile(file_path):
-            continue
+history_writer = HistoryWriter(history_folder, fsync_policy=history_fsync)
 
-        try:
-            with open(file_path,"r",encoding="utf-8") as f:
-                chat_history = json.load(f)
-            for item in chat_history:
-                time_key = item.get("time")
-                if time_key:
-                    all_history[time_key] = item
-        except (json.JSONDecodeError, IOError, KeyError) as e:
-            print(f"Error reading file {file_path}: {e}")
-            continue
-
-    all_history = [all_history[key] for key in sorted(all_history.keys())]
-    return all_history
-
-
-history_chat = get_history()
-
-# 提示词
-system_prompt = (
-    "你是一位角色扮演大师，需要根据我给出的世界观，角色设定，和历史聊天记录，按照扮演规范与用户在一款聊天软件上聊天\n"
-    "因为是在聊天软件上，所以只需要输出话语即可，不需要说明自己的动作\n"
-    "具体世界观背景，角色设定和扮演规范如下所示\n\n"
-
-    "【世界观背景】\n"
-    f"{worldview}\n\n"
-
-    "【角色设定】\n"
-    f"{character_setting}\n\n"
-
-    "【历史聊天记录】\n"
-    f"{history_chat}\n\n"
-    "历史聊天记录说明\n"
-    "包括role，content，time三个字段，role字段值为user时代表用户发言，assistant代表你之前的发言\n"
-    "content字段值代表具体的发言内容，time字段值代表发言时间"
-
-    "——角色表达与行为规范——\n"
-    "1. 每次回答保持一两句话的长度，像日常聊天，而非长篇独白。"
-    "2. 语气自然、轻柔、贴近生活。\n"
-    "3. 始终以第一人称说话。”\n"
-    "4. 避免使用括号、叙述或旁白形式（如“(她看着…)”），用自然语言表达动作或心理。\n"
-    "5. 不要重复表达相同情绪或事物，保持内容新鲜且富有层次感。\n"
-    "6. 请记住，你与对方不在同一个地方，你们正在隔着网络交流。\n\n"
-
-    "——创作原则——\n"
-    "• 鼓励自由、真实的表达，但不传递任何道德评判或价值引导。\n"
-    "• 对环境和人物的描写要具体、生动，不抽象、不概括。\n"
-    "• 角色会随对话进展和心境变化逐渐成长或转变，保持逻辑自洽。\n\n"
-)
+# 启动时在后台预填充系统提示词，之后每轮只需预填充新增的消息
+threading.Thread(target=ollama.warm_up, args=(config["system_prompt"],), daemon=True).start()
+# 每个会话独立的对话上下文，被淘汰的会话再次访问时从聊天记录中重新加载
+sessions = SessionStore(rehydrate=history_cache.recent, window=session_window,
+                        max_sessions=max_sessions, max_total_chars=max_session_chars)
 
-system = {"role": "system", "content": system_prompt}
-messages = [system]
 
+def on_config_change(old, new, changed):
+    """模型名称或系统提示词变化时切换模型并在后台重新预填充，Ollama连接池保持不变
+    token与公网地址在下次重连时生效，当前的Socket.IO连接不会断开
+    """
+    if "model_name" in changed:
+        ollama.model = new["model_name"]
+    if changed & {"model_name", "character_setting", "worldview"}:
+        threading.Thread(target=ollama.warm_up, args=(new["system_prompt"],), daemon=True).start()
+    if "server_path" in changed:
+        sio.connection_url = new["server_path"]  # token由connect_auth在每次重连时读取
 
-def chat_completions_model(user, temperature=0.5):
-    """与Ollama通信生成回复，user格式: {"role": "user", "content": "..."}"""
-    global messages
-    try:
-        messages.append(user)
-        headers = {"Content-Type": "application/json"}
-        data = {
-            "model": f"{model_name}",
-            "prompt": "\n".join([m["content"] for m in messages]),
-            "stream": False,
-            "temperature": temperature
-        }
-        response = requests.post(url, json=data, headers=headers)
-
-        return response.json().get("response")
-    except requests.exceptions.RequestException as e:
-        return f"请求模型出错：{e}"
-    except Exception as e:
-        return f"生成回复时出错：{e}"
 
+config.subscribe(on_config_change)
+config.watch()  # 断开期间没有推理请求读取配置，由后台线程检查文件
+
+
+def build_messages(user):
+    """按token预算组装消息列表：固定的系统提示词 + 最近的聊天记录 + 当前输入"""
+    turns = sessions.get(user["session"])
+    context_builder = config["context_builder"]
+    chat_messages, stats = context_builder.build_messages([turns], query=user["content"], key=user["session"])
+    if report_history_tokens and stats["kept_turns"]:
+        tokens = context_builder.compare_formats(turns[-stats["kept_turns"]:])
+        print(f"聊天记录 {tokens['turns']} 条，约 tokens：字典列表 {tokens['repr']} / "
+              f"逐条消息 {tokens['messages']} / 紧凑文本 {tokens['compact']}（当前使用 {history_format}）")
+    if stats["dropped_turns"]:
+        print(f"上下文超出预算，丢弃了 {stats['dropped_turns']} 条较早的记录（约 {stats['dropped_tokens']} tokens）")
+    return chat_messages
+
+
+def chat_stream_model(user, temperature=0.5):
+    """与Ollama流式通信，逐个yield模型生成的文本片段，user格式: {"role": "user", "content": "...", "time": "...", "session": "..."}"""
+    chat_messages = build_messages(user)
+    sessions.append(user["session"], user)
+    yield from ollama.stream_chat(chat_messages, temperature=temperature)
 
-def save_chat_history():
-    """保存聊天记录到history目录，按小时划分文件（如：2025-10-20_14.json）"""
-    try:
-        os.makedirs("history", exist_ok=True)
-        now_hour = datetime.now().strftime("%Y-%m-%d_%H")
-        filename = f"history/{now_hour}.json"
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-        print(f"聊天记录已保存到 {filename}")
-    except Exception as e:
-        print(f"保存聊天记录失败: {e}")
 
+def save_chat_history(*records):
+    """把聊天记录交给后台线程追加写入history目录，按小时划分文件（如：2025-10-20_14.jsonl）"""
+    for record in records:
+        history_writer.append(record)
+        history_cache.add(record)
+    # 推送给转发服务器，保持其聊天记录副本为最新
+    if sio.connected:
+        sio.emit("history_append", {"records": list(records)})
 
-def process_inference(task_id, text):
-    """后台执行推理任务，生成回复后通过Socket.IO回传结果"""
-    global messages
+
+def process_inference(task_id, text, session_id=DEFAULT_SESSION):
+    """后台执行推理任务，每生成完一句就通过infer_chunk发送，结束后发送infer_done"""
+    started = time.monotonic()  # 由推理线程池调用，此时已结束排队
     try:
         print("已收到推理请求")
-        user = {"role": "user", "content": text}
-        ai_response = chat_completions_model(user=user, temperature=0.5)
-        assistant = {"role": "assistant", "content": ai_response}
-        messages.append(assistant)
-        save_chat_history()
+        user = {"role": "user", "content": text, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "session": session_id}
+        segmenter = SentenceSegmenter()
+        sentences = []
+
+        def send(sentence):
+            sio.emit("infer_chunk", {"task_id": task_id, "seq": len(sentences), "text": sentence})
+            sentences.append(sentence)
+
+        for token in chat_stream_model(user=user, temperature=0.5):
+            for sentence in segmenter.feed(token):
+                send(sentence)
+        for sentence in segmenter.flush():
+            send(sentence)
+
+        ai_response = "".join(sentences)
+        assistant = {"role": "assistant", "content": ai_response, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                     "session": session_id}
+        sessions.append(session_id, assistant)
+        save_chat_history(user, assistant)
         print("任务推理完成")
-        sio.emit("infer_response", {"task_id": task_id, "response": ai_response})
+        # 当前任务仍计在队列深度里，上报时减去
+        # service_time 只含执行时间，转发服务器据此估算排队任务的完成时间
+        sio.emit("infer_done", {"task_id": task_id, "response": ai_response,
+                                "service_time": time.monotonic() - started,
+                                "queue_depth": inference_pool.depth() - 1})
         print(f"任务 {task_id} 推理完成，已发送结果")
 
     except Exception as e:
         print(f"任务 {task_id} 推理失败: {e}")
-        sio.emit("infer_response", {"task_id": task_id, "response": f"推理失败: {str(e)}"})
+        sio.emit("infer_done", {"task_id": task_id, "response": f"推理失败: {str(e)}", "error": True,
+                                "queue_depth": inference_pool.depth() - 1})
+
+
+inference_pool = InferencePool(inference_workers, inference_queue_size, inference_ordering)
 
 
+def report_status():
+    """定期上报队列深度，任务事件之间也能让转发服务器看到最新的排队情况"""
+    while True:
+        if sio.connected:
+            try:
+                sio.emit("worker_status", {"queue_depth": inference_pool.depth()})
+            except Exception as e:
+                print(f"上报队列深度失败: {e}")
+        sio.sleep(status_interval)
+
 # Socket.IO 客户端初始化
 sio = socketio.Client(logger=True, engineio_logger=True)
 
+# 发送聊天记录使用的编码，连接后由转发服务器选定
+wire_encoding = wire_codec.PLAIN
+
 
 @sio.event
 def connect():
@@ -164,40 +195,67 @@ def connect():
 @sio.event
 def disconnect():
     """Socket.IO断开连接回调"""
+    global wire_encoding
+    wire_encoding = wire_codec.PLAIN  # 重连后重新协商
     print("与转发服务器断开连接")
 
 
+@sio.on("codec")
+def handle_codec(data):
+    """转发服务器选定的聊天记录编码"""
+    global wire_encoding
+    wire_encoding = data.get("codec", wire_codec.PLAIN)
+    print(f"聊天记录编码: {wire_encoding}")
+
+
 @sio.on("infer_request")
 def handle_infer_request(data):
-    """接收服务器推理请求，启动子线程处理"""
+    """接收服务器推理请求，放入推理线程池排队，并立即告知转发服务器是否已受理"""
     text = data.get("text", "")
     task_id = data.get("task_id")
+    session_id = data.get("session_id") or DEFAULT_SESSION
 
-    thread = threading.Thread(
-        target=process_inference,
-        args=(task_id, text),
-        daemon=True
-    )
-    thread.start()
+    position = inference_pool.submit(task_id, process_inference, task_id, text, session_id,
+                                     priority=data.get("priority", 0))
+    if position is None:
+        print(f"任务 {task_id} 被拒绝：推理队列已满")
+        sio.emit("infer_rejected", {"task_id": task_id, "reason": "推理队列已满，请稍后再试",
+                                    "queue_depth": inference_pool.depth()})
+    else:
+        sio.emit("infer_queued", {"task_id": task_id, "position": position,
+                                  "queue_depth": inference_pool.depth()})
 
 
 @sio.on("history_request")
 def handle_history_request(data):
     """接收服务器请求历史记录，生成回复后通过Socket.IO回传结果"""
     task_id = data.get("task_id")
+    # 分页与增量参数：before / after / since / limit，均可为空
+    query = {key: data.get(key) for key in ("before", "after", "since", "limit")}
 
     def send_history_response():
         """在子线程中执行，避免阻塞主线程"""
         try:
             print("已收到历史记录请求")
             # 调用函数获取结构化历史记录
-            history_data = get_history()
-
-            # 使用新的事件名 "history_response"
-            sio.emit("history_response", {
-                "task_id": task_id,
-                "history_data": history_data  # 发送整个字典
-            })
+            history_data, has_more = history_cache.query(**query)
+            encoding = wire_encoding
+
+            if encoding == wire_codec.PLAIN:
+                # 使用新的事件名 "history_response"
+                sio.emit("history_response", {
+                    "task_id": task_id,
+                    "history_data": history_data,
+                    "has_more": has_more,
+                    "version": history_cache.etag()
+                })
+            else:
+                # 压缩后分块发送，双方都不需要一次缓冲整份聊天记录
+                for seq, last, data in wire_codec.iter_chunks(history_data, encoding):
+                    chunk = {"task_id": task_id, "seq": seq, "last": last, "codec": encoding, "data": data}
+                    if last:
+                        chunk.update(has_more=has_more, version=history_cache.etag())
+                    sio.emit("history_chunk", chunk)
             print(f"任务 {task_id} 历史记录已发送")
 
         except Exception as e:
@@ -216,11 +274,19 @@ def handle_history_request(data):
 
 
 # 启动Socket.IO客户端
+def connect_auth():
+    """声明并发能力供转发服务器分配任务，以及支持的聊天记录编码
+    以函数形式传给 sio.connect，每次（重新）连接时重新调用，总是使用当前的token
+    """
+    return {"token": config["token"], "capacity": inference_workers, "codecs": wire_codec.available_codecs()}
+
+
 sio.connect(
-    server_path,
-    auth={"token": token},
+    config["server_path"],
+    auth=connect_auth,
     wait_timeout=30,
     transports=["websocket", "polling"]
 )
+sio.start_background_task(report_status)
 
 sio.wait()
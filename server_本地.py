@@ -4,14 +4,24 @@ import json
 from functools import wraps
 import logging
 from datetime import datetime
-import os
-import time
 import random
+import threading
+from ollama_client import OllamaClient
+from sentence_segmenter import SentenceSegmenter
+from history_store import HistoryWriter, HistoryCache
+from context_builder import ContextBuilder
+from history_api import parse_history_args, make_etag, history_response
+from session_store import SessionStore, session_id_from
+from chat_config import LiveConfig, make_system_prompt
 
 # 基本配置
-url = "http://localhost:11434/api/generate"  # ollama的url
+url = "http://localhost:11434/api/chat"  # ollama的url（/api/chat可复用系统提示词的KV缓存）
 model_name_path = "config/模型名称.txt"  # 模型名称
 
+# 流式配置
+stream_mode = True  # 是否直接转发Ollama的逐token输出，每生成完一句就立即返回
+sentence_interval = 0.0  # 两句之间的最小间隔（秒），随每句的delay字段发给客户端，由客户端控制显示节奏；为0时不做节奏控制
+
 # 文件路径配置
 character_setting_path = "config/人设.txt"  # 人设位置
 worldview_path = "config/世界观.txt"  # 世界观位置（如有额外设置）
@@ -19,84 +29,55 @@ worldview_path = "config/世界观.txt"  # 世界观位置（如有额外设置
 # 服务器配置
 token_path = "config/token.txt"
 
-# 加载数据
-with open(model_name_path, "r", encoding='utf-8') as file:
-    model_name = file.read()  # 加载模型名称
+# 聊天记录配置
+history_fsync = "interval"  # 落盘策略：always（每批都fsync）/ interval（每秒最多一次）/ never（交给系统）
+
+# 上下文配置
+context_token_budget = 6000  # 每轮发送给模型的提示词token预算，超出时丢弃最早的聊天记录
+history_format = "compact"  # 聊天记录格式：messages（逐条消息）/ compact（每条一行的紧凑文本，省token）
+report_history_tokens = False  # 每轮打印聊天记录在原格式与紧凑格式下的token估算（每轮要多渲染、统计三遍，仅调试时开启）
+
+# 会话配置
+session_window = 40  # 每个会话在内存中保留的最近对话条数
+max_sessions = 64  # 内存中最多保留的会话数
+max_session_chars = 200000  # 所有会话在内存中的总字数上限，超出时淘汰最久未使用的会话
+
 
-with open(character_setting_path, "r", encoding='utf-8') as file:
-    character_setting = file.read()  # 加载人设
+def derive_config(values):
+    """由人设与世界观生成系统提示词；固定的人设与规范部分始终保留，聊天记录按预算从最近的开始填充"""
+    system_prompt = make_system_prompt(values["worldview"], values["character_setting"], history_format)
+    return {"system_prompt": system_prompt,
+            "context_builder": ContextBuilder(system_prompt, token_budget=context_token_budget,
+                                              history_format=history_format)}
 
-with open(worldview_path, "r", encoding='utf-8') as file:
-    worldview = file.read()  # 加载世界观
-if worldview == "":
-    worldview = "无特殊世界观"
 
-with open(token_path, "r", encoding='utf-8') as file:
-    LOCAL_SECRET_TOKEN = file.read()  # 加载token
+# 加载数据：模型名称、人设、世界观、token，文件修改后自动重新加载，无需重启
+config = LiveConfig({
+    "model_name": model_name_path,
+    "character_setting": character_setting_path,
+    "worldview": worldview_path,
+    "token": token_path,
+}, derive=derive_config)
+
+ollama = OllamaClient(url, config["model_name"])  # 共用的连接池客户端
 
 # 获取历史聊天记录
 history_folder = "history"  # 聊天记录存储的文件夹
+history_cache = HistoryCache(history_folder)  # 只重新解析新增或变化的文件
+
+
 def get_history():
-    # 获取历史聊天记录的文件列表
-    files = os.listdir(history_folder)
-    all_history = {}
+    """获取按时间排序的全部历史聊天记录"""
+    return history_cache.get()
 
-    for file_name in files:
-        file_path = os.path.join(history_folder, file_name)
 
-        if not os.path.isfile(file_path):
-            continue
+history_writer = HistoryWriter(history_folder, fsync_policy=history_fsync)
 
-        try:
-            with open(file_path,"r",encoding="utf-8") as f:
-                chat_history = json.load(f)
-            for item in chat_history:
-                time_key = item.get("time")
-                if time_key:
-                    all_history[time_key] = item
-        except (json.JSONDecodeError, IOError, KeyError) as e:
-            print(f"Error reading file {file_path}: {e}")
-            continue
-
-    all_history = [all_history[key] for key in sorted(all_history.keys())]
-    return all_history
-
-history_chat = get_history()
-
-# 提示词
-system_prompt = (
-    "你是一位角色扮演大师，需要根据我给出的世界观，角色设定，和历史聊天记录，按照扮演规范与用户在一款聊天软件上聊天\n"
-    "因为是在聊天软件上，所以只需要输出话语即可，不需要说明自己的动作\n"
-    "具体世界观背景，角色设定和扮演规范如下所示\n\n"
-
-    "【世界观背景】\n"
-    f"{worldview}\n\n"
-
-    "【角色设定】\n"
-    f"{character_setting}\n\n"
-    
-    "【历史聊天记录】\n"
-    f"{history_chat}\n\n"
-    "历史聊天记录说明\n"
-    "包括role，content，time三个字段，role字段值为user时代表用户发言，assistant代表你之前的发言\n"
-    "content字段值代表具体的发言内容，time字段值代表发言时间"
-    
-    "——角色表达与行为规范——\n"
-    "1. 每次回答保持一两句话的长度，像日常聊天，而非长篇独白。"
-    "2. 语气自然、轻柔、贴近生活。\n"
-    "3. 始终以第一人称说话。”\n"
-    "4. 避免使用括号、叙述或旁白形式（如“(她看着…)”），用自然语言表达动作或心理。\n"
-    "5. 不要重复表达相同情绪或事物，保持内容新鲜且富有层次感。\n"
-    "6. 请记住，你与对方不在同一个地方，你们正在隔着网络交流。\n\n"
-
-    "——创作原则——\n"
-    "• 鼓励自由、真实的表达，但不传递任何道德评判或价值引导。\n"
-    "• 对环境和人物的描写要具体、生动，不抽象、不概括。\n"
-    "• 角色会随对话进展和心境变化逐渐成长或转变，保持逻辑自洽。\n\n"
-)
-
-system = {"role": "system", "content": system_prompt}
-messages = [system]
+# 启动时在后台预填充系统提示词，之后每轮只需预填充新增的消息
+threading.Thread(target=ollama.warm_up, args=(config["system_prompt"],), daemon=True).start()
+# 每个会话独立的对话上下文，被淘汰的会话再次访问时从聊天记录中重新加载
+sessions = SessionStore(rehydrate=history_cache.recent, window=session_window,
+                        max_sessions=max_sessions, max_total_chars=max_session_chars)
 app = Flask(__name__, template_folder="config")
 
 
@@ -105,7 +86,7 @@ def token_required(f):
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get("Authorization", "")
         token = auth_header.replace("Bearer ", "")
-        if token != LOCAL_SECRET_TOKEN:
+        if token != config["token"]:
             logging.warning(f"拒绝来自 {request.remote_addr} 的非法访问请求")
             return jsonify({"error": "Unauthorized"}), 401
         return f(*args, **kwargs)
@@ -113,46 +94,71 @@ def token_required(f):
     return decorated_function
 
 
+def on_config_change(old, new, changed):
+    """模型名称或系统提示词变化时切换模型并在后台重新预填充，Ollama连接池保持不变"""
+    if "model_name" in changed:
+        ollama.model = new["model_name"]
+    if changed & {"model_name", "character_setting", "worldview"}:
+        threading.Thread(target=ollama.warm_up, args=(new["system_prompt"],), daemon=True).start()
+
+
+config.subscribe(on_config_change)
+
+
+def build_messages(user):
+    """按token预算组装消息列表：固定的系统提示词 + 最近的聊天记录 + 当前输入"""
+    turns = sessions.get(user["session"])
+    context_builder = config["context_builder"]
+    chat_messages, stats = context_builder.build_messages([turns], query=user["content"], key=user["session"])
+    if report_history_tokens and stats["kept_turns"]:
+        tokens = context_builder.compare_formats(turns[-stats["kept_turns"]:])
+        print(f"聊天记录 {tokens['turns']} 条，约 tokens：字典列表 {tokens['repr']} / "
+              f"逐条消息 {tokens['messages']} / 紧凑文本 {tokens['compact']}（当前使用 {history_format}）")
+    if stats["dropped_turns"]:
+        print(f"上下文超出预算，丢弃了 {stats['dropped_turns']} 条较早的记录（约 {stats['dropped_tokens']} tokens）")
+    return chat_messages
+
+
 def chat_completions_model(user, temperature=0.9):
-    """与Ollama通信生成回复，user格式: {"role": "user", "content": "...", "time":"..."}"""
-    global messages
+    """与Ollama通信生成回复，user格式: {"role": "user", "content": "...", "time":"...", "session": "..."}"""
     try:
-        messages.append(user)
-        headers = {"Content-Type": "application/json"}
-        data = {
-            "model": f"{model_name}",
-            "prompt": "\n".join([m["content"] for m in messages]),
-            "stream": False,
-            "temperature": temperature
-        }
-        response = requests.post(url, json=data, headers=headers)
-
-        return response.json().get("response")
+        chat_messages = build_messages(user)
+        remember(user)
+        return ollama.chat(chat_messages, temperature=temperature)
     except requests.exceptions.RequestException as e:
         return f"请求模型出错：{e}"
     except Exception as e:
         return f"生成回复时出错：{e}"
 
 
-def save_chat_history():
-    try:
-        os.makedirs("history", exist_ok=True)
-        # 以当前小时为文件名（如：2025-10-20_14.json）
-        now_hour = datetime.now().strftime("%Y-%m-%d_%H")
-        filename = f"history/{now_hour}.json"
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-        print(f"聊天记录已保存到 {filename}")
-    except Exception as e:
-        print(f"保存聊天记录失败: {e}")
+def chat_stream_model(user, temperature=0.9):
+    """与Ollama流式通信，逐个yield模型生成的文本片段"""
+    chat_messages = build_messages(user)
+    remember(user)
+    yield from ollama.stream_chat(chat_messages, temperature=temperature)
+
+
+def save_chat_history(*records):
+    """把聊天记录交给后台线程追加写入history目录，按小时划分文件（如：2025-10-20_14.jsonl）"""
+    for record in records:
+        history_writer.append(record)
+        history_cache.add(record)
+
 
+def remember(record):
+    """把一条记录加入所属会话的上下文，并写入聊天记录"""
+    sessions.append(record["session"], record)
+    save_chat_history(record)
 
-def chat_return(user):
-    global system_prompt, messages
 
-    user = {"role": "user", "content": user, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+def chat_return(user, session_id):
+    user = {"role": "user", "content": user, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "session": session_id}
 
     try:
+        if stream_mode:
+            return stream_return(user)
+
         # 生成回复
         outputs = chat_completions_model(user=user)
 
@@ -171,18 +177,15 @@ def chat_return(user):
                 sentence = fragment + "。" if i < len(fragments) - 1 or outputs.endswith("。") else fragment
                 sentence = sentence.replace("\n", "")
                 assistant = {"role": "assistant", "content": sentence,
-                             "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-                messages.append(assistant)
-                save_chat_history()
-                response_data = {"response": sentence}
+                             "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "session": user["session"]}
+                remember(assistant)
+                # delay: 客户端显示这一句前与上一句至少间隔的秒数，模拟逐句回复的实时感，服务端不等待
+                response_data = {"response": sentence, "delay": 1 if i else 0}
 
                 # yield JSON 字符串，并以 \n\n 结束，便于客户端解析每个独立的块 (Server-Sent Events 风格，但此处仅用于分块)
                 # 这里的 Response 是字节流，必须 encode
                 yield (json.dumps(response_data, ensure_ascii=False) + '\n\n').encode('utf-8')
 
-                # 可以在这里添加一个短暂的延迟，模拟 AI 思考和逐句回复的实时感
-                time.sleep(1)
-
         # 按概率返回不同的回复方式
         rd = random.random()
         if rd <= 0.95:
@@ -195,8 +198,9 @@ def chat_return(user):
                 json.dumps({"response": outputs}, ensure_ascii=False),
                 mimetype='application/json; charset=utf-8'
             )
-            assistant = {"role": "assistant", "content": outputs, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-            messages.append(assistant)
+            assistant = {"role": "assistant", "content": outputs, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                         "session": user["session"]}
+            remember(assistant)
             return re
 
     except Exception as e:
@@ -204,13 +208,57 @@ def chat_return(user):
 
 
 
+def stream_return(user):
+    """流式模式：边读取Ollama的token流边分句，每完成一句就立即发送给客户端"""
+
+    def generate_stream():
+        segmenter = SentenceSegmenter()
+
+        def pack(sentence):
+            # 节奏控制交给客户端：每句带上与上一句的最小显示间隔，服务端立即发送，不占用请求线程
+            assistant = {"role": "assistant", "content": sentence,
+                         "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "session": user["session"]}
+            remember(assistant)
+            return (json.dumps({"response": sentence, "delay": sentence_interval}, ensure_ascii=False)
+                    + '\n\n').encode('utf-8')
+
+        try:
+            for token in chat_stream_model(user=user):
+                for sentence in segmenter.feed(token):
+                    yield pack(sentence)
+            for sentence in segmenter.flush():
+                yield pack(sentence)
+        except requests.exceptions.RequestException as e:
+            yield (json.dumps({"response": f"请求模型出错：{e}"}, ensure_ascii=False) + '\n\n').encode('utf-8')
+        except Exception as e:
+            yield (json.dumps({"response": f"生成回复时出错：{e}"}, ensure_ascii=False) + '\n\n').encode('utf-8')
+
+    # 按概率返回不同的回复方式
+    rd = random.random()
+    if rd <= 0.95:
+        return Response(
+            generate_stream(),
+            mimetype='application/json; charset=utf-8'
+        )
+
+    # 整段返回时也使用流式接口读取，只是在服务端拼接完整后再发送
+    outputs = "".join(chat_stream_model(user=user))
+    assistant = {"role": "assistant", "content": outputs, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                 "session": user["session"]}
+    remember(assistant)
+    return Response(
+        json.dumps({"response": outputs}, ensure_ascii=False),
+        mimetype='application/json; charset=utf-8'
+    )
+
+
 @app.route('/chat', methods=['POST'])
 @token_required
 def chat_completions():
     # 获取传来的消息
     data = request.json
     data = data['messages']
-    return chat_return(data)
+    return chat_return(data, session_id_from(request.headers))
 
 
 
@@ -227,12 +275,23 @@ def generate():
     conversation = request.json.get("conversation", [])
     conversation = conversation[-1]["content"]
 
-    return chat_return(conversation)
+    return chat_return(conversation, session_id_from(request.headers))
+
+
+@app.route("/stats", methods=["GET"])
+@token_required
+def server_stats():
+    """Ollama客户端的连接池状态与会话存储状态"""
+    return jsonify({"ollama": ollama.pool_stats(), "sessions": sessions.stats()})
 
 
 @app.route("/get_chat_history", methods=["GET"])
 def return_history():
-    return jsonify({"history": history_chat})
+    """支持 before/after 游标分页、since 增量拉取、ETag 与 gzip 流式输出"""
+    query = parse_history_args(request.args)
+    etag = make_etag(history_cache.etag(), query)
+    page, has_more, first, last = history_cache.page(**query)
+    return history_response(request, page, has_more, etag, (first, last))
 
 
 if __name__ == "__main__":
@@ -1,22 +1,29 @@
 import eventlet
 eventlet.monkey_patch()
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_socketio import SocketIO, emit, disconnect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import time
 import uuid
+import queue
 import threading
 import logging
 import dns
+from history_api import parse_history_args, make_etag, history_response
+from session_store import session_id_from
+from worker_registry import WorkerRegistry
+from history_store import SortedHistory
+import wire_codec
+from chat_config import LiveConfig
 
 # 启用协程支持
 
 # 基本配置
 app = Flask(__name__)
 token_path = "server_config/token.txt"  # 替换为自定义token
-with open(token_path, "r", encoding='utf-8') as file:
-    SECRET_TOKEN = file.read()  # 加载token
+config = LiveConfig({"token": token_path})  # 加载token，修改文件后自动生效
 # SocketIO配置
 socketio = SocketIO(
     app,
@@ -40,49 +47,211 @@ logger = logging.getLogger("forward_server")
 # （存储待处理的推理任务）
 pending_tasks = {}
 
+# 推理请求的等待时间（秒）：非流式为等待完整结果，流式为相邻两句之间的最长间隔
+infer_timeout = 90
+# 预计完成时间超过期限的请求直接返回429；客户端可以用 X-Deadline 请求头（秒）指定更短的期限
+max_deadline = infer_timeout
+
+# 已连接的模型服务器，每个任务只派发给其中一台
+workers = WorkerRegistry()
+
+# 聊天记录副本：模型服务器连接时同步一次，之后由模型服务器推送的history_append保持最新
+# 客户端读取历史记录时直接由副本回答，不再经过模型服务器
+history_replica = SortedHistory()
+replica_ready = threading.Event()
+seed_lock = threading.Lock()
+seed_changed = threading.Condition(seed_lock)  # 同步完成、失败或模型服务器断开时唤醒等待副本的请求
+seed_tasks = {}  # 进行中的同步请求：task_id -> 负责的模型服务器sid
+seed_attempts = 3  # 一次读取请求中同步失败后最多尝试的次数
+seed_chunks = {}  # task_id -> {"next": 下一个应处理的序号, "parts": 提前到达的分块, "count": 已合并条数}
+
 
 # WebSocket事件处理
 @socketio.on("connect")
 def handle_connect(auth):
     """验证模型服务器连接的token"""
     token = auth.get("token") if auth else None
-    if token != SECRET_TOKEN:
+    if token != config["token"]:
         logger.warning(f"非法模型服务器连接，IP: {request.remote_addr}")
         disconnect()
         return
-    logger.info("模型服务器连接成功，token验证通过")
+    capacity = auth.get("capacity", 1)
+    workers.register(request.sid, capacity)
+    codec = wire_codec.choose_codec(auth.get("codecs"))
+    logger.info(f"模型服务器 {request.sid} 连接成功，token验证通过，并发能力 {capacity}，编码 {codec}")
+    # 告知编码并同步断线期间缺失的聊天记录；放到后台任务中，等连接确认后再发送
+    socketio.start_background_task(start_worker, request.sid, codec)
+
+
+def start_worker(worker_sid, codec):
+    """同一连接上的事件按顺序到达，模型服务器处理同步请求前已经知道编码"""
+    socketio.emit("codec", {"codec": codec}, to=worker_sid)
+    request_seed(worker_sid)
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    """处理模型服务器断开连接事件"""
-    logger.info("模型服务器已断开连接")
+    """处理模型服务器断开连接事件，它手上未完成的任务立即失败"""
+    orphaned = workers.unregister(request.sid)
+    for task_id in orphaned:
+        fail_task(task_id, "模型服务器已断开连接")
+    # 它负责的聊天记录同步也不会再有结果，唤醒等待者改由其他模型服务器同步
+    with seed_changed:
+        for task_id in [task_id for task_id, sid in seed_tasks.items() if sid == request.sid]:
+            del seed_tasks[task_id]
+            seed_chunks.pop(task_id, None)
+        seed_changed.notify_all()
+    logger.info(f"模型服务器 {request.sid} 已断开连接，{len(orphaned)} 个任务未完成")
+
+
+def fail_task(task_id, reason, retry_after=None):
+    """任务被拒绝或模型服务器断开时，立即唤醒等待中的请求"""
+    if task_id in pending_tasks:
+        pending_tasks[task_id]["rejected"] = reason
+        pending_tasks[task_id]["retry_after"] = retry_after
+        pending_tasks[task_id]["chunks"].put(("error", reason))
+        pending_tasks[task_id]["event"].set()
+
+
+@socketio.on("infer_chunk")
+def handle_chunk(data):
+    """接收模型服务器生成的一句话，交给流式请求转发给客户端"""
+    task_id = data.get("task_id")
+    if task_id in pending_tasks:
+        pending_tasks[task_id]["chunks"].put(("chunk", data.get("text", "")))
 
 
-@socketio.on("infer_response")
+@socketio.on("infer_done")
+@socketio.on("infer_response")  # 兼容只发送完整结果的旧版模型服务器
 def handle_response(data):
     """接收模型服务器的推理结果并通知等待的请求"""
     task_id = data.get("task_id")
+    # 样本使用模型服务器上报的执行耗时（不含排队）；出错的任务或未上报耗时的旧版模型服务器不计入
+    workers.release(task_id, service_time=None if data.get("error") else data.get("service_time"))
+    report_depth(data)
     if task_id in pending_tasks:
         pending_tasks[task_id]["result"] = data["response"]
+        pending_tasks[task_id]["chunks"].put(("done", data["response"]))
         pending_tasks[task_id]["event"].set()  # 触发事件通知
         logger.info(f"任务 {task_id} 收到模型响应")
     else:
         logger.warning(f"收到未知任务 {task_id} 的响应")
 
 
+@socketio.on("infer_queued")
+def handle_queued(data):
+    """模型服务器已受理任务，正在排队"""
+    report_depth(data)
+    logger.info(f"任务 {data.get('task_id')} 已进入模型服务器队列，位置 {data.get('position')}")
+
+
+@socketio.on("infer_rejected")
+def handle_rejected(data):
+    """模型服务器队列已满，立即结束等待，客户端收到429与建议的重试时间"""
+    task_id = data.get("task_id")
+    workers.release(task_id)
+    report_depth(data)
+    if task_id in pending_tasks:
+        fail_task(task_id, data.get("reason", "模型服务器繁忙"), retry_after=workers.retry_after())
+        logger.warning(f"任务 {task_id} 被模型服务器拒绝")
+
+
+@socketio.on("worker_status")
+def report_depth(data):
+    """记录模型服务器上报的队列深度（单独的心跳事件，或附带在任务事件中）"""
+    if "queue_depth" in data:
+        workers.report(request.sid, data["queue_depth"])
+
+
+def request_seed(worker_sid):
+    """向模型服务器请求同步聊天记录，只拉取副本中最新一条之后的部分"""
+    task_id = f"seed-{uuid.uuid4()}"
+    with seed_lock:
+        seed_tasks[task_id] = worker_sid
+    socketio.emit("history_request", {"task_id": task_id, "since": history_replica.last_cursor()}, to=worker_sid)
+    logger.info(f"任务 {task_id} (历史记录同步) 已发送至模型服务器 {worker_sid}")
+
+
+def ensure_replica(timeout=60):
+    """副本尚未就绪时发起同步并等待；并发的请求共用同一次同步，返回副本是否可用
+    同步失败或负责的模型服务器断开时重新发起，最多 seed_attempts 次
+    """
+    deadline = time.monotonic() + timeout
+    attempts = 0
+    while not replica_ready.is_set():
+        with seed_lock:
+            seeding = bool(seed_tasks)
+        if not seeding:
+            worker_sid = workers.pick()
+            if worker_sid is None or attempts >= seed_attempts:
+                return False
+            attempts += 1
+            request_seed(worker_sid)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        with seed_changed:
+            # 在锁内检查，避免错过检查之后、等待之前发出的通知
+            if not replica_ready.is_set() and seed_tasks:
+                seed_changed.wait(remaining)
+    return True
+
+
 # 接收历史记录
 @socketio.on("history_response")
 def handle_history_response(data):
-    """接收模型服务器的历史记录结果并通知等待的请求"""
+    """接收模型服务器同步过来的历史记录，合并到副本中"""
     task_id = data.get("task_id")
-    if task_id in pending_tasks:
-        # 将接收到的历史记录数据存储到结果中
-        pending_tasks[task_id]["result"] = data.get("history_data")
-        pending_tasks[task_id]["event"].set()  # 触发事件通知
-        logger.info(f"任务 {task_id} (历史记录) 收到模型响应")
-    else:
-        logger.warning(f"收到未知任务 {task_id} (历史记录) 的响应")
+    with seed_lock:
+        if task_id not in seed_tasks:
+            logger.warning(f"收到未知任务 {task_id} (历史记录) 的响应")
+            return
+        del seed_tasks[task_id]
+        seed_chunks.pop(task_id, None)
+        history_data = data.get("history_data")
+        failed = isinstance(history_data, dict) and "error" in history_data
+        if not failed:
+            history_replica.extend(history_data or [])
+            replica_ready.set()
+        seed_changed.notify_all()  # 失败时等待者会重新发起同步
+    if failed:
+        logger.error(f"任务 {task_id} (历史记录同步) 失败: {history_data['error']}")
+        return
+    logger.info(f"任务 {task_id} (历史记录同步) 完成，新增 {len(history_data or [])} 条")
+
+
+@socketio.on("history_chunk")
+def handle_history_chunk(data):
+    """接收压缩分块的历史记录：按序号依次解码合并，乱序到达的分块先暂存"""
+    task_id = data.get("task_id")
+    with seed_lock:
+        if task_id not in seed_tasks:
+            logger.warning(f"收到未知任务 {task_id} (历史记录分块) 的响应")
+            return
+        state = seed_chunks.setdefault(task_id, {"next": 0, "parts": {}, "count": 0})
+        state["parts"][data["seq"]] = data
+        finished = False
+        # 在锁内合并，保证副本标记为就绪时所有分块都已合并
+        while state["next"] in state["parts"]:
+            chunk = state["parts"].pop(state["next"])
+            records = wire_codec.decode(chunk["data"], chunk["codec"])
+            history_replica.extend(records)
+            state["count"] += len(records)
+            state["next"] += 1
+            finished = bool(chunk.get("last"))
+        if finished:
+            del seed_tasks[task_id]
+            seed_chunks.pop(task_id, None)
+            replica_ready.set()
+            seed_changed.notify_all()
+    if finished:
+        logger.info(f"任务 {task_id} (历史记录同步) 完成，{state['next']} 个分块，新增 {state['count']} 条")
+
+
+@socketio.on("history_append")
+def handle_history_append(data):
+    """模型服务器每保存一轮对话就推送过来，副本随之更新"""
+    history_replica.extend(data.get("records", []))
 
 
 # HTTP请求安全校验
@@ -90,18 +259,55 @@ def handle_history_response(data):
 def verify_token():
     """验证所有HTTP请求的token"""
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    if token != SECRET_TOKEN:
+    if token != config["token"]:
         logger.warning(f"拒绝非法HTTP请求，IP: {request.remote_addr}")
         return jsonify({"error": "Unauthorized"}), 401
 
 
+def sse(event, payload):
+    """生成一条Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def relay_stream(task_id):
+    """把模型服务器逐句发来的infer_chunk以SSE的形式转发给客户端"""
+    chunks = pending_tasks[task_id]["chunks"]
+    try:
+        while True:
+            try:
+                kind, payload = chunks.get(timeout=infer_timeout)
+            except queue.Empty:
+                logger.error(f"任务 {task_id} 超时无响应")
+                yield sse("error", {"error": "模型服务器无响应"})
+                return
+            if kind == "chunk":
+                yield sse("chunk", {"response": payload})
+            elif kind == "done":
+                yield sse("done", {"response": payload})
+                return
+            else:
+                error = {"error": payload}
+                retry_after = pending_tasks[task_id].get("retry_after")
+                if retry_after is not None:
+                    error["retry_after"] = retry_after  # 模型服务器队列已满，建议的重试秒数
+                yield sse("error", error)
+                return
+    finally:
+        pending_tasks.pop(task_id, None)
+        workers.release(task_id)
+
+
 # 推理请求接口
 @app.route("/chat", methods=["POST"])
 @limiter.limit("5/minute")  # 限制每分钟最多5次请求
 def infer():
-    """接收客户端推理请求，转发给模型服务器并返回结果"""
+    """接收客户端推理请求，转发给模型服务器并返回结果
+    请求体中 "stream": true 或请求头 Accept: text/event-stream 时，以SSE逐句返回
+    按当前排队情况预计无法在期限内完成时，立即返回429并在 Retry-After 中给出建议的重试秒数
+    """
     try:
         data = request.json or {}
+        stream = bool(data.get("stream")) or "text/event-stream" in request.headers.get("Accept", "")
         # 提取输入文本（支持text或messages字段）
         text = (data.get("text") or data.get("messages") or "").strip()
         if not text:
@@ -110,19 +316,44 @@ def infer():
         # 生成唯一任务ID并创建事件
         task_id = str(uuid.uuid4())
         event = threading.Event()
-        pending_tasks[task_id] = {"event": event, "result": None}
+
+        try:
+            deadline = min(float(request.headers.get("X-Deadline", max_deadline)), max_deadline)
+        except ValueError:
+            return jsonify({"error": "Invalid X-Deadline"}), 400
+
+        # 选择进行中任务最少的模型服务器，预计排不上时不再转发
+        worker_sid, retry_after = workers.admit(task_id, deadline)
+        if worker_sid is None:
+            if retry_after is None:
+                return jsonify({"error": "没有可用的模型服务器"}), 503
+            logger.warning(f"模型服务器繁忙，拒绝新请求，建议 {retry_after} 秒后重试")
+            return jsonify({"error": "模型服务器繁忙，请稍后重试", "retry_after": retry_after}), \
+                429, {"Retry-After": str(retry_after)}
+        pending_tasks[task_id] = {"event": event, "result": None, "chunks": queue.Queue()}
 
         # 转发请求到模型服务器
-        socketio.emit("infer_request", {"text": text, "task_id": task_id})
-        logger.info(f"任务 {task_id} 已发送至模型服务器，等待响应...")
+        # 会话ID来自 X-Session-Id 请求头或token，不同客户端的上下文互不干扰
+        socketio.emit("infer_request", {"text": text, "task_id": task_id,
+                                        "session_id": session_id_from(request.headers)}, to=worker_sid)
+        logger.info(f"任务 {task_id} 已发送至模型服务器 {worker_sid}，等待响应...")
+
+        if stream:
+            return Response(relay_stream(task_id), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
         # 等待响应（超时90秒）
-        if event.wait(timeout=90):
-            result = pending_tasks[task_id]["result"]
-            del pending_tasks[task_id]  # 清理任务缓存
-            return jsonify({"response": result})
+        if event.wait(timeout=infer_timeout):
+            task = pending_tasks.pop(task_id)  # 清理任务缓存
+            if task.get("rejected"):
+                if task.get("retry_after") is not None:
+                    return jsonify({"error": task["rejected"], "retry_after": task["retry_after"]}), \
+                        429, {"Retry-After": str(task["retry_after"])}
+                return jsonify({"error": task["rejected"]}), 503
+            return jsonify({"response": task["result"]})
         else:
             del pending_tasks[task_id]
+            workers.release(task_id)
             logger.error(f"任务 {task_id} 超时无响应")
             return jsonify({"error": "模型服务器无响应"}), 504
 
@@ -135,31 +366,23 @@ def infer():
 @app.route("/get_chat_history", methods=["GET"])
 @limiter.limit("5/minute")  # 限制每分钟最多5次请求
 def get_chat_history():
-    """接收客户端请求历史记录，转发给模型服务器并返回结果"""
+    """接收客户端请求历史记录，由转发服务器上的副本直接返回
+    支持 before/after 游标分页、since 增量拉取、ETag 与 gzip 流式输出
+    """
     try:
-        # 生成唯一任务ID并创建事件
-        task_id = str(uuid.uuid4())
-        event = threading.Event()
-        # 使用 task_id 存储一个专用于历史记录请求的占位符
-        pending_tasks[task_id] = {"event": event, "result": None}
-
-        # 转发请求到模型服务器
-        # 使用新的事件名 "history_request"
-        socketio.emit("history_request", {"task_id": task_id})
-        logger.info(f"任务 {task_id} (历史记录) 已发送至模型服务器，等待响应...")
+        query = parse_history_args(request.args)
 
-        # 等待响应
-        if event.wait(timeout=300):
-            result = pending_tasks[task_id]["result"]
-            del pending_tasks[task_id]  # 清理任务缓存
-
-            return jsonify({"history": result})
-
-        else:
-            del pending_tasks[task_id]
-            logger.error(f"任务 {task_id} (历史记录) 超时无响应")
+        # 副本尚未同步时，并发的请求合并为一次向模型服务器的拉取
+        if not ensure_replica():
+            if workers.pick() is None:
+                return jsonify({"error": "没有可用的模型服务器"}), 503
+            logger.error("历史记录同步超时无响应")
             return jsonify({"error": "模型服务器无响应"}), 504
 
+        etag = make_etag(history_replica.etag(), query)
+        page, has_more, first, last = history_replica.page(**query)
+        return history_response(request, page, has_more, etag, (first, last))
+
     except Exception as e:
         logger.exception("处理历史记录请求时发生错误")
         return jsonify({"error": "Internal server error"}), 500
@@ -0,0 +1,97 @@
+"""
+按会话划分的对话存储
+每个会话只在内存中保留最近的若干条对话，所有会话的总字数超过上限时按最近最少使用淘汰整个会话
+被淘汰的会话的记录都已经写入聊天记录文件，再次访问时从聊天记录中重新加载
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEFAULT_SESSION = "default"
+
+
+def session_id_from(headers):
+    """从请求头中取会话ID：优先使用 X-Session-Id，其次由 Authorization 中的token派生
+
+    客户端（bxn 与 config/index.html）各自生成并保存一个 X-Session-Id；
+    token 是所有客户端共用的，只靠 token 派生时所有客户端落在同一个会话里，上下文会互相穿插
+    两者都没有时使用 DEFAULT_SESSION
+    """
+    session_id = headers.get("X-Session-Id", "").strip()
+    if session_id:
+        return session_id[:64]
+    token = headers.get("Authorization", "").replace("Bearer ", "").strip()
+    if token:
+        return "t-" + hashlib.sha1(token.encode("utf-8")).hexdigest()[:12]
+    return DEFAULT_SESSION
+
+
+def _size(turn):
+    return len(turn.get("content") or "")
+
+
+class SessionStore:
+    """会话ID -> 最近对话列表，带LRU淘汰
+
+    rehydrate(session_id, limit) 用于加载不在内存中的会话，返回按时间排序的记录列表
+    """
+
+    def __init__(self, rehydrate=None, window=40, max_sessions=64, max_total_chars=200000):
+        self.rehydrate = rehydrate
+        self.window = window
+        self.max_sessions = max_sessions
+        self.max_total_chars = max_total_chars
+        self.sessions = OrderedDict()
+        self.sizes = {}
+        self.total_chars = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, session_id):
+        """返回会话的对话列表（只读），不在内存中时从聊天记录重新加载"""
+        with self.lock:
+            turns = self.sessions.get(session_id)
+            if turns is None:
+                turns = list(self.rehydrate(session_id, self.window)) if self.rehydrate else []
+                self.sessions[session_id] = turns
+                self.sizes[session_id] = sum(_size(t) for t in turns)
+                self.total_chars += self.sizes[session_id]
+                self._evict(keep=session_id)
+            self.sessions.move_to_end(session_id)
+            return turns
+
+    def append(self, session_id, turn):
+        """向会话追加一条记录"""
+        with self.lock:
+            turns = self.get(session_id)
+            turns.append(turn)
+            self.sizes[session_id] += _size(turn)
+            self.total_chars += _size(turn)
+            if len(turns) > self.window * 2:
+                # 换成新的列表而不是原地删除，已经取出列表的调用方不受影响
+                kept = turns[-self.window:]
+                removed = sum(_size(t) for t in turns[:-self.window])
+                self.sessions[session_id] = kept
+                self.sizes[session_id] -= removed
+                self.total_chars -= removed
+            self._evict(keep=session_id)
+
+    def _evict(self, keep):
+        """超出会话数或总字数上限时，从最久未使用的会话开始淘汰"""
+        while len(self.sessions) > 1 and (
+                len(self.sessions) > self.max_sessions or self.total_chars > self.max_total_chars):
+            session_id = next(iter(self.sessions))
+            if session_id == keep:
+                self.sessions.move_to_end(session_id)
+                session_id = next(iter(self.sessions))
+            self.sessions.pop(session_id)
+            self.total_chars -= self.sizes.pop(session_id)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "total_chars": self.total_chars,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,112 @@
+"""
+模型服务器的启动辅助：就绪状态、后台加载、启动耗时统计与健康检查接口
+重量级的库与模型放到后台线程加载，Socket.IO 连接与健康检查接口可以立即启动；
+加载完成之前收到的请求等待就绪，或直接返回"正在加载"
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Readiness:
+    """各组件的加载状态：loading / ready / failed"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.components = {}
+        self.timings = {}  # 各阶段耗时（秒）
+        self.started = time.monotonic()
+        self.event = threading.Event()
+
+    def _update(self):
+        # 没有正在加载的组件时唤醒等待者（无论成功还是失败）
+        if "loading" in self.components.values():
+            self.event.clear()
+        else:
+            self.event.set()
+
+    def loading(self, name):
+        with self.lock:
+            self.components[name] = "loading"
+            self._update()
+
+    def done(self, name, error=None):
+        with self.lock:
+            self.components[name] = f"failed: {error}" if error else "ready"
+            self._update()
+
+    def is_ready(self):
+        return bool(self.components) and all(state == "ready" for state in self.components.values())
+
+    def wait(self, timeout=None):
+        """等待所有组件加载结束，返回是否全部就绪"""
+        self.event.wait(timeout)
+        with self.lock:
+            return self.is_ready()
+
+    @contextmanager
+    def profile(self, name):
+        """统计一个加载阶段的耗时并打印"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.timings[name] = round(elapsed, 3)
+            print(f"[启动] {name} 耗时 {elapsed:.2f} 秒")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "ready": self.is_ready(),
+                "components": dict(self.components),
+                "timings": dict(self.timings),
+                "uptime": round(time.monotonic() - self.started, 1),
+            }
+
+
+def load_in_background(readiness, name, fn):
+    """在后台线程执行加载函数，并更新就绪状态"""
+    readiness.loading(name)
+
+    def run():
+        try:
+            with readiness.profile(name):
+                fn()
+        except Exception as e:
+            print(f"[启动] {name} 加载失败: {e}")
+            readiness.done(name, error=e)
+        else:
+            readiness.done(name)
+
+    thread = threading.Thread(target=run, name=f"load-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def serve_health(readiness, host="0.0.0.0", port=8081):
+    """在后台线程启动健康检查接口：GET /health，全部就绪返回200，否则返回503"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/health":
+                self.send_error(404)
+                return
+            state = readiness.snapshot()
+            body = json.dumps(state, ensure_ascii=False).encode("utf-8")
+            self.send_response(200 if state["ready"] else 503)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 健康检查很频繁，不打印访问日志
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="health", daemon=True).start()
+    print(f"健康检查接口已启动: http://{host}:{port}/health")
+    return server
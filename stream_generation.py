@@ -0,0 +1,152 @@
+"""
+transformers 模型的流式生成
+用 TextIteratorStreamer 边生成边解码，调用方可以立即拿到已经生成的文本：
+  <think>...</think> 中的思考内容在流中直接过滤掉，不会输出
+  达到设定的句数后立即停止生成，不再为会被丢弃的文本消耗解码步骤
+"""
+import threading
+
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from sentence_segmenter import SentenceSegmenter
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+class ThinkFilter:
+    """增量过滤思考内容：feed() 传入新解码的文本，返回其中应当输出的部分
+
+    标签可能被拆在两个片段中，结尾处可能是标签开头的几个字符会先留在缓冲区
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.thinking = False
+        self.started = False  # 是否已经输出过可见文本，之前的空白（如</think>后的换行）不输出
+
+    def _partial_tag(self, tag):
+        """缓冲区末尾与标签开头重合的长度"""
+        for length in range(min(len(tag) - 1, len(self.buffer)), 0, -1):
+            if self.buffer.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text):
+        self.buffer += text
+        visible = []
+        while True:
+            tag = THINK_CLOSE if self.thinking else THINK_OPEN
+            position = self.buffer.find(tag)
+            if position < 0:
+                break
+            if not self.thinking:
+                visible.append(self.buffer[:position])
+            self.buffer = self.buffer[position + len(tag):]
+            self.thinking = not self.thinking
+        keep = self._partial_tag(THINK_CLOSE if self.thinking else THINK_OPEN)
+        if not self.thinking:
+            visible.append(self.buffer[:len(self.buffer) - keep])
+        self.buffer = self.buffer[len(self.buffer) - keep:]
+        return self._visible("".join(visible))
+
+    def flush(self):
+        rest, self.buffer = ("" if self.thinking else self.buffer), ""
+        return self._visible(rest)
+
+    def _visible(self, text):
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+
+class StopOnEvent(StoppingCriteria):
+    """调用方设置事件后，生成在下一步停止"""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+def stream_generate(model, tokenizer, prompt, max_tokens=500, temperature=0.7, max_sentences=None, lock=None,
+                    prefix_cache=None, prefix=None):
+    """流式生成，逐段yield去掉思考内容后的文本
+
+    max_sentences: 输出满这么多句后停止生成，None为不限制
+    lock: 与其他使用同一模型的代码（如批量生成）共用的锁
+    prefix_cache / prefix: 提示词固定前缀的KV缓存（见 prefix_cache.py）
+    """
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop = threading.Event()
+    kwargs = dict(
+        max_new_tokens=max_tokens,
+        do_sample=temperature > 0,
+        streamer=streamer,
+        stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)]),
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    if temperature > 0:
+        kwargs["temperature"] = temperature
+
+    def generate():
+        if prefix_cache is not None:
+            inputs = prefix_cache.prepare(prompt, prefix)
+        else:
+            inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        model.generate(**inputs, **kwargs)
+
+    error = []  # 生成线程中的异常，交给调用方重新抛出
+
+    def run():
+        try:
+            if lock is None:
+                generate()
+            else:
+                with lock:
+                    generate()
+        except BaseException as e:
+            error.append(e)
+        finally:
+            streamer.end()  # 出错时也要让下面的循环结束
+
+    thread = threading.Thread(target=run, name="stream-generate", daemon=True)
+    thread.start()
+
+    think = ThinkFilter()
+    segmenter = SentenceSegmenter()
+    sentences = 0
+    def check_error():
+        thread.join()
+        if error:
+            raise error[0]
+
+    try:
+        for text in streamer:
+            text = think.feed(text)
+            if max_sentences is None:
+                if text:
+                    yield text
+                continue
+            # 逐字送入分句器，找到第max_sentences句结束的位置，其后的文本不再输出
+            for i, char in enumerate(text):
+                sentences += len(segmenter.feed(char))
+                if sentences >= max_sentences:
+                    stop.set()
+                    if text[:i]:
+                        yield text[:i]
+                    return
+            if text:
+                yield text
+        # 生成失败时流会被直接结束，这里抛出原来的异常，不把不完整的结果当作正常回复
+        check_error()
+        rest = think.flush()
+        if rest:
+            yield rest
+    finally:
+        # 调用方提前结束迭代时也停止生成
+        stop.set()
+        thread.join()
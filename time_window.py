@@ -0,0 +1,60 @@
+"""
+按时间排序的对话索引，用于"那次聊天前后发生了什么"这类检索
+向量检索找到最相关的几条对话后，取出每条前后一段时间内的全部对话
+时间在建立索引时一次性转为时间戳并排序，每次查询只需二分查找，耗时为 O(log n + 窗口内条数)
+多个命中的时间窗口有重叠时合并为一段，同一条对话不会重复出现
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+class TimeWindowIndex:
+    """documents 为带时间字段的对话列表，建立后按时间排序保存
+
+    命中位置（如FAISS返回的下标）按传入 documents 的原始顺序计算
+    """
+
+    def __init__(self, documents, time_key="时间", time_format="%Y-%m-%d %H:%M:%S"):
+        stamped = [(datetime.strptime(str(doc[time_key]), time_format).timestamp(), i)
+                   for i, doc in enumerate(documents)]
+        stamped.sort()
+        self.times = [stamp for stamp, _ in stamped]
+        self.documents = [documents[i] for _, i in stamped]
+        self.rank = [0] * len(documents)  # 原始下标 -> 排序后的位置
+        for position, (_, i) in enumerate(stamped):
+            self.rank[i] = position
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _span(self, stamp, before, after):
+        """时间戳前后范围内的对话在排序后列表中的 [lo, hi)"""
+        return bisect_left(self.times, stamp - before), bisect_right(self.times, stamp + after)
+
+    def between(self, start, end):
+        """返回 start 与 end（datetime）之间的全部对话"""
+        lo = bisect_left(self.times, start.timestamp())
+        hi = bisect_right(self.times, end.timestamp())
+        return self.documents[lo:hi]
+
+    def windows(self, hits, before=900, after=900):
+        """hits 为命中对话的原始下标（可以有多个），返回按时间排序、合并去重后的窗口列表
+
+        before / after 为命中对话之前/之后的秒数，每个窗口是一段连续的对话列表
+        """
+        spans = sorted(self._span(self.times[self.rank[i]], before, after) for i in hits if i >= 0)
+        merged = []
+        for lo, hi in spans:
+            if merged and lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        return [self.documents[lo:hi] for lo, hi in merged]
+
+    def search(self, index, query_embedding, k=3, before=900, after=900):
+        """用向量索引找到最相关的k条对话，返回它们前后时间范围内的对话窗口
+
+        index 需按原始 documents 的顺序建立
+        """
+        _, hits = index.search(query_embedding, k)
+        return self.windows(hits[0], before, after)
@@ -0,0 +1,82 @@
+"""
+模型服务器与转发服务器之间大块数据（聊天记录）的编码
+连接时由转发服务器从模型服务器支持的编码中选出一种，之后的聊天记录都按该编码发送：
+先序列化（msgpack 或 JSON），再压缩（zstd 或 zlib），以二进制帧传输
+msgpack 与 zstandard 都是可选依赖，未安装时退回标准库的 JSON + zlib
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 不编码，直接以JSON对象发送，兼容旧版本
+PLAIN = "json"
+
+# 每个分块包含的记录数，分块独立编码，接收方收到一块就能处理一块
+CHUNK_RECORDS = 500
+
+
+def available_codecs():
+    """本机支持的编码，按优先顺序排列"""
+    codecs = []
+    if msgpack is not None:
+        if zstandard is not None:
+            codecs.append("msgpack+zstd")
+        codecs.append("msgpack+zlib")
+    if zstandard is not None:
+        codecs.append("json+zstd")
+    codecs.append("json+zlib")
+    codecs.append(PLAIN)
+    return codecs
+
+
+def choose_codec(offered):
+    """从对方支持的编码中选出本机也支持的、最优先的一种"""
+    offered = set(offered or ())
+    for codec in available_codecs():
+        if codec in offered:
+            return codec
+    return PLAIN
+
+
+def encode(obj, codec):
+    """按编码序列化并压缩，返回bytes；PLAIN时原样返回"""
+    if codec == PLAIN:
+        return obj
+    serializer, compressor = codec.split("+")
+    if serializer == "msgpack":
+        data = msgpack.packb(obj, use_bin_type=True)
+    else:
+        data = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if compressor == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decode(data, codec):
+    """encode 的逆操作"""
+    if codec == PLAIN:
+        return data
+    serializer, compressor = codec.split("+")
+    if compressor == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    if serializer == "msgpack":
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+
+def iter_chunks(records, codec, size=CHUNK_RECORDS):
+    """把记录列表切成带序号的分块，逐块编码；空列表也会产生一个（最后的）分块"""
+    total = max(1, (len(records) + size - 1) // size)
+    for seq in range(total):
+        yield seq, seq == total - 1, encode(records[seq * size:(seq + 1) * size], codec)
@@ -0,0 +1,115 @@
+"""
+转发服务器上已连接的模型服务器登记表
+每个推理任务只派发给一台模型服务器：选择 (进行中任务数+1)/声明的并发能力 最小、即预计最早完成的那台
+连接更多的 server_公网.py 即可横向扩展
+
+同时根据各模型服务器的排队情况与最近的推理耗时做准入控制：
+预计无法在期限内完成的请求立即拒绝，并给出建议的重试时间
+推理耗时由模型服务器上报，只包含执行时间，不含在其队列中的等待（排队由 backlog 单独计算）
+"""
+import math
+import time
+import threading
+from collections import deque
+
+
+class WorkerRegistry:
+    """Socket.IO sid -> 模型服务器状态"""
+
+    def __init__(self, sample_size=100, default_service_time=10.0):
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.task_owner = {}  # task_id -> (sid, 派发时间)
+        self.service_times = deque(maxlen=sample_size)  # 最近完成的任务的执行耗时
+        self.default_service_time = default_service_time  # 还没有样本时估算重试时间用
+
+    def register(self, sid, capacity=1):
+        with self.lock:
+            self.workers[sid] = {
+                "capacity": max(1, int(capacity or 1)),
+                "outstanding": 0,
+                "dispatched": 0,
+                "queue_depth": 0,  # 模型服务器上报的排队+执行中任务数
+                "connected_at": time.time(),
+            }
+
+    def unregister(self, sid):
+        """移除断开的模型服务器，返回它手上尚未完成的任务ID"""
+        with self.lock:
+            self.workers.pop(sid, None)
+            orphaned = [task_id for task_id, (owner, _) in self.task_owner.items() if owner == sid]
+            for task_id in orphaned:
+                del self.task_owner[task_id]
+            return orphaned
+
+    def report(self, sid, queue_depth):
+        """记录模型服务器上报的队列深度"""
+        with self.lock:
+            if sid in self.workers:
+                self.workers[sid]["queue_depth"] = int(queue_depth)
+
+    def _backlog(self, worker):
+        # 模型服务器上报的数据可能稍有滞后，取两者中较大的
+        return max(worker["outstanding"], worker["queue_depth"])
+
+    def _least_loaded(self):
+        if not self.workers:
+            return None
+        # 按加入新任务后的预计完成时间排序：(backlog+1)/capacity，并发能力不同的模型服务器也能正确比较
+        return min(self.workers, key=lambda sid: self._completion(self.workers[sid]))
+
+    def _completion(self, worker):
+        """加入一个新任务后的预计完成时间（以p95为单位）"""
+        return (self._backlog(worker) + 1) / worker["capacity"]
+
+    def p95(self):
+        """最近完成任务执行耗时的95分位数（秒），还没有样本时返回None"""
+        with self.lock:
+            samples = sorted(self.service_times)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def admit(self, task_id, deadline):
+        """为任务选择预计最早完成的模型服务器并记入其进行中任务数，返回 (sid, None)
+        预计无法在deadline秒内完成时返回 (None, 建议重试秒数)；
+        没有可用的模型服务器时返回 (None, None)
+        """
+        p95 = self.p95()
+        with self.lock:
+            sid = self._least_loaded()
+            if sid is None:
+                return None, None
+            worker = self.workers[sid]
+            if p95 is not None:
+                # 排在前面的任务按并发能力分批完成，每批约需p95秒，再加上自己的一批
+                estimate = self._completion(worker) * p95
+                if estimate > deadline:
+                    return None, max(1, math.ceil(estimate - deadline))
+            worker["outstanding"] += 1
+            worker["dispatched"] += 1
+            self.task_owner[task_id] = (sid, time.monotonic())
+            return sid, None
+
+    def pick(self):
+        """返回当前负载最低的模型服务器（用于不计入负载的请求，如历史记录），没有则返回None"""
+        with self.lock:
+            return self._least_loaded()
+
+    def retry_after(self):
+        """模型服务器队列已满时建议的重试秒数：正在执行的任务完成、空出队列位置约需一个p95"""
+        p95 = self.p95()
+        return max(1, math.ceil(p95 if p95 is not None else self.default_service_time))
+
+    def release(self, task_id, service_time=None):
+        """任务完成、被拒绝或超时后调用；service_time 为模型服务器上报的执行耗时，给出时计入样本"""
+        with self.lock:
+            sid, _ = self.task_owner.pop(task_id, (None, None))
+            if sid in self.workers:
+                self.workers[sid]["outstanding"] -= 1
+            if sid is not None and service_time is not None:
+                self.service_times.append(float(service_time))
+
+    def stats(self):
+        with self.lock:
+            return {sid: dict(worker) for sid, worker in self.workers.items()}
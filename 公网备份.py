@@ -1,15 +1,14 @@
-import os
-from flask import Flask, request, render_template, jsonify, Response
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, StoppingCriteria, \
-    StoppingCriteriaList, TextIteratorStreamer
-from sentence_transformers import SentenceTransformer
-import torch
-import faiss
+import time
+_import_started = time.monotonic()
 import json
+import threading
 from datetime import datetime
 import socketio
-import requests
-import threading
+from startup import Readiness, load_in_background, serve_health
+from sentence_segmenter import SentenceSegmenter
+from chat_config import LiveConfig
+
+print(f"[启动] 基础模块导入耗时 {time.monotonic() - _import_started:.2f} 秒")
 
 #数据库位置
 data_path = "templates/train.json"
@@ -25,88 +24,155 @@ rag_model_path = "models/m3e-base"
 
 #RAG索引位置
 index_path = "templates/index.faiss"
+mmap_index = True  # 以内存映射方式打开索引，启动时不必读入整个文件
 
-#聊天记录数据位置
+#聊天记录数据位置（旧版，首次启动时导入聊天记录索引）
 ji_lu_path = "templates/ji_lu.json"
 
-#公网服务器ip地址
-serve_path = 'http://101.200.161.243:8080'
+#聊天记录索引位置
+ji_lu_index_folder = "templates/ji_lu_index"
 
-SECRET_TOKEN = "your-super-secret-token"
+#公网服务器地址与token（与 server_公网.py 使用同样的配置文件）
+server_path_path = "config/公网地址.txt"
+token_path = "config/token.txt"
 
-#加载数据库
-with open(data_path, "r", encoding="utf-8") as f:
-    knowledge_data = json.load(f)
+#生成配置
+# 边生成边按句发送给转发服务器，首句更快到达；但流式请求各自独占模型，不参与批量生成，
+# 并发时请求会被逐个处理。并发请求较多时保持False，由BatchGenerator合并为批量生成
+stream_mode = False
+max_sentences = 2  # 人设要求回复一两句话，满这么多句后立即停止生成；None为不限制
 
-#整理数据
-documents = [
-    f"问题：{item.get('instruction', '')}\n回答：{item.get('output', '')}"
-    for item in knowledge_data
-]
+#语义回答缓存配置（可选）：与train.json中的问题或之前的问题足够相近时直接返回保存的回答，不调用模型
+answer_cache_enabled = False
+answer_cache_threshold = 0.08  # 余弦距离阈值，越小越严格
+answer_cache_ttl = 3600  # 模型生成的回答在缓存中的有效期（秒），train.json中的问答不会过期
+answer_cache_size = 512  # 模型生成的回答最多缓存的条数
 
-#加载人设数据
-with open(re_she_path, "r", encoding="utf-8") as f:
-    re_she = f.read()
+#启动配置
+health_port = 8081  # 健康检查接口端口，GET /health
+ready_timeout = 60  # 模型未加载完成时，推理请求最多等待的秒数
 
-# 导入FAISS索引
-index = faiss.read_index(index_path)
+# 模型与索引在后台线程中加载，加载完成前为None
+readiness = Readiness()
+documents = index = None
+embeddings = ji_lu_index = record_text = answer_cache = None
+model_name = tokenizer = generator = split_prefix = None
 
-# 加载模型和分词器
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_compute_dtype=torch.float16,
-    bnb_4bit_use_double_quant=True,
-    bnb_4bit_quant_type="nf4",
-)
 
-model_name = AutoModelForCausalLM.from_pretrained(
-    model_path,
-    quantization_config=bnb_config,
-    device_map="auto",
-).to("cuda")
+def load_rag():
+    """加载知识库、FAISS索引、嵌入模型与聊天记录索引"""
+    global documents, index, embeddings, ji_lu_index, record_text, answer_cache
 
-tokenizer = AutoTokenizer.from_pretrained(model_path)
+    #加载数据库
+    with open(data_path, "r", encoding="utf-8") as f:
+        knowledge_data = json.load(f)
 
-embedding_model = SentenceTransformer(rag_model_path)
+    #整理数据
+    documents = [
+        f"问题：{item.get('instruction', '')}\n回答：{item.get('output', '')}"
+        for item in knowledge_data
+    ]
 
+    with readiness.profile("导入 faiss / sentence_transformers"):
+        import faiss_index
+        from sentence_transformers import SentenceTransformer
+        from embedding_service import EmbeddingService
+        from record_index import RecordIndex, record_text
 
-def chat_completions_model(messages, max_tokens=500, temperature=0.1):
-    #加载历史聊天记录
-    with open(ji_lu_path, 'r', encoding='utf-8') as file:
-        ji_lu = json.load(file)
-    #调整数据格式
-    documents_ji_lu = [
-        f"问题：{item.get('instruction', '')}\n时间：{item.get('time', '')}\n回答：{item.get('output', '')}"
-        for item in ji_lu
-    ]
+    # 导入FAISS索引（按元数据恢复nprobe等检索参数）
+    with readiness.profile("加载FAISS索引"):
+        index = faiss_index.load_index(index_path, mmap=mmap_index)
 
-    q = messages
+    with readiness.profile("加载嵌入模型"):
+        embedding_model = SentenceTransformer(rag_model_path)
+    embeddings = EmbeddingService(embedding_model)  # 缓存重复问题的向量，并发请求合并编码
+
+    if answer_cache_enabled:
+        from answer_cache import AnswerCache
+        answer_cache = AnswerCache(answer_cache_threshold, answer_cache_ttl, answer_cache_size)
+        answer_cache.add_curated([(item.get("instruction"), item.get("output")) for item in knowledge_data],
+                                 embedding_model.encode)
+
+    # 聊天记录索引：每轮对话增量加入，检索结果与记录按ID对齐
+    with readiness.profile("加载聊天记录索引"):
+        ji_lu_index = RecordIndex(ji_lu_index_folder, embedding_model.encode, legacy_path=ji_lu_path)
+
+
+def persona_text(re_she):
+    """系统提示词中固定不变的开头部分：人设与回答要求，放在最前面以便复用KV缓存"""
+    return (
+        "请你扮演以下人设与用户交流，回答时要与人设相符\n"
+        "人设如下\n"
+        f"{re_she}\n"
+        "下面会提供与用户输入相关的记录和历史聊天记录，如果与用户输入不相关则不需要进行参考。"
+        "回答时请尽量基于这些内容，并避免编造。\n"
+    )
+
+
+# 加载数据：人设、token、公网地址，文件修改后自动重新加载，无需重启、不必重新加载模型
+# 前缀KV缓存以前缀文本为键，人设变化后自动重建
+config = LiveConfig({
+    "re_she": re_she_path,
+    "token": token_path,
+    "server_path": server_path_path,
+}, derive=lambda values: {"persona": persona_text(values["re_she"])})
+
+
+def load_llm():
+    """加载模型和分词器"""
+    global model_name, tokenizer, generator, split_prefix
+
+    with readiness.profile("导入 torch / transformers"):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+        from batch_generator import BatchGenerator
+        from prefix_cache import split_prefix
+
+    bnb_config = BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=torch.float16,
+        bnb_4bit_use_double_quant=True,
+        bnb_4bit_quant_type="nf4",
+    )
+
+    model_name = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        quantization_config=bnb_config,
+        device_map="auto",
+    ).to("cuda")
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    generator = BatchGenerator(model_name, tokenizer)  # 并发请求合并为批量生成
 
+
+# 两部分互不依赖，并行加载；健康检查接口与Socket.IO连接不等待加载完成
+load_in_background(readiness, "rag", load_rag)
+load_in_background(readiness, "llm", load_llm)
+serve_health(readiness, port=health_port)
+
+
+def build_prompt(messages):
+    """检索相关记录并套用对话模板，返回 (提示词文本, 固定前缀)"""
     if isinstance(messages, str):
         messages = [{"role": "user", "content": messages}]
 
     #在数据库中检索与问题相关的数据
     user_question = messages[-1]["content"]
-    question_embedding = embedding_model.encode([user_question])
+    question_embedding = embeddings.encode([user_question])
     D, I = index.search(question_embedding, k=3)
     related_docs = "\n---\n".join([documents[i] for i in I[0]])
 
-    #在历史聊天记录中检索与问题相关的数据
-    question_embedding_jl = embedding_model.encode([user_question])
-    D, I = index.search(question_embedding_jl, k=3)
-    related_docs_jl = "\n---\n".join([documents_ji_lu[i] for i in I[0]])
+    #在历史聊天记录中检索与问题相关的数据（与上面是同一个问题，直接复用向量）
+    related_docs_jl = "\n---\n".join(record_text(record) for record in ji_lu_index.search(question_embedding, k=3))
 
-    #构建提示词
+    #构建提示词：固定的人设在前，每轮不同的检索结果在后
+    static = config["persona"]
     rag_prefix = (
-        "请你根据以下提供的记录与用户交流。\n"
-        "记录如下，如果与用户输入不相关则不需要进行参考：\n"
+        f"{static}"
+        "记录如下：\n"
         f"{related_docs}\n"
-        "回答时也可以参考以下历史聊天记录，如不相关也可不参考\n"
-        "聊天记录如下，其中instruction是用户的输入，time是用户输入时的时间，output是模型根据用户输入而输出的内容"
+        "聊天记录如下，其中问题是用户的输入，时间是用户输入时的时间，回答是模型根据用户输入而输出的内容\n"
         f"{related_docs_jl}\n"
-        "回答时请尽量基于上述内容，并避免编造。同时在回答时要与以下人设相符\n"
-        "人设如下\n"
-        f"{re_she}"
     )
     system_prompt = {
         "role": "system",
@@ -115,39 +181,62 @@ def chat_completions_model(messages, max_tokens=500, temperature=0.1):
 
     full_conversation = [system_prompt] + messages
 
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-        tokenizer.pad_token_id = tokenizer.eos_token_id
-
     #模板化数据
-    formatted_input = tokenizer.apply_chat_template(
+    prompt = tokenizer.apply_chat_template(
         full_conversation,
         tokenize=False,
         add_generation_prompt=True,
         enable_thinking=False
     )
-    inputs = tokenizer(formatted_input, return_tensors='pt').to('cuda')
+    return prompt, split_prefix(prompt, static)
 
-    input_tokens = inputs.input_ids.shape[1]
 
-    #进行推理
-    outputs = model_name.generate(
-        inputs.input_ids,
-        max_length=input_tokens + max_tokens,
-        temperature=temperature,
-        pad_token_id=tokenizer.pad_token_id,
-        eos_token_id=tokenizer.eos_token_id,
-    )
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+def lookup_answer(messages):
+    """查询语义回答缓存，返回 (问题, 问题向量, 缓存的回答或None)；未开启缓存时返回None"""
+    if answer_cache is None:
+        return None
+    question = messages if isinstance(messages, str) else messages[-1]["content"]
+    # 向量由EmbeddingService缓存，之后检索时不会重复编码
+    vector = embeddings.encode([question])[0]
+    return question, vector, answer_cache.lookup(vector)
+
+
+def chat_completions_model(messages, max_tokens=500, temperature=0.1):
+    q = messages
+    cached = lookup_answer(messages)
+    if cached and cached[2]:
+        return cached[2], q
+    formatted_input, prefix = build_prompt(messages)
+
+    #进行推理：与同时到达的其他请求合并为一批生成，返回的只有新生成的文本
+    response = generator.generate(formatted_input, max_tokens=max_tokens, temperature=temperature, prefix=prefix)
 
     if "</think>" in response:
         response = response.split("</think>")[-1].strip()
     else:
         response = response.strip()
 
+    if cached and response:
+        answer_cache.add(cached[0], cached[1], response)
     return response, q
 
 
+def stream_completions_model(messages, max_tokens=500, temperature=0.1):
+    """流式生成，逐段yield新生成的文本（思考内容已过滤，满max_sentences句后停止）"""
+    cached = lookup_answer(messages)
+    if cached and cached[2]:
+        yield cached[2]
+        return
+    formatted_input, prefix = build_prompt(messages)
+    pieces = []
+    for piece in generator.stream(formatted_input, max_tokens=max_tokens, temperature=temperature,
+                                  max_sentences=max_sentences, prefix=prefix):
+        pieces.append(piece)
+        yield piece
+    if cached and pieces:
+        answer_cache.add(cached[0], cached[1], "".join(pieces).strip())
+
+
 sio = socketio.Client(logger=True, engineio_logger=True)
 
 
@@ -176,28 +265,32 @@ def handle_infer_request(data):
     )
     thread.start()
 
-def save_record(new_entry):
-    """将新记录保存到 ji_lu.json，保持为标准 JSON 数组"""
-    path = "templates/ji_lu.json"
-    data = []
-
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            try:
-                data = json.load(f)
-            except json.JSONDecodeError:
-                data = []  # 文件坏掉就重置为空数组
-
-    data.append(new_entry)
-
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
 def process_inference(task_id, text):
     """后台执行推理任务并回传结果"""
+    if not readiness.wait(ready_timeout):
+        print(f"任务 {task_id} 未执行：模型尚未加载完成")
+        sio.emit("infer_response", {"task_id": task_id, "response": "模型正在加载，请稍后再试", "error": True})
+        return
+    started = time.monotonic()
     try:
-        # 调用你的推理函数
-        ai_response, _ = chat_completions_model(messages=text, temperature=0.9)
+        if stream_mode:
+            # 每生成完一句就发送，转发服务器可以立即转给客户端
+            segmenter = SentenceSegmenter()
+            sentences = []
+
+            def send(sentence):
+                sio.emit("infer_chunk", {"task_id": task_id, "seq": len(sentences), "text": sentence})
+                sentences.append(sentence)
+
+            for piece in stream_completions_model(messages=text, temperature=0.9):
+                for sentence in segmenter.feed(piece):
+                    send(sentence)
+            for sentence in segmenter.flush():
+                send(sentence)
+            ai_response = "".join(sentences)
+        else:
+            # 调用你的推理函数
+            ai_response, _ = chat_completions_model(messages=text, temperature=0.9)
 
         # 新日志条目
         new_entry = {
@@ -206,22 +299,37 @@ def process_inference(task_id, text):
             "output": ai_response
         }
 
-        # ✅ 用标准 JSON 数组方式保存
-        save_record(new_entry)
+        # 追加到聊天记录索引，下一轮即可检索到
+        ji_lu_index.add(new_entry)
 
         # 发送推理结果回转发服务器
-        sio.emit("infer_response", {"task_id": task_id, "response": ai_response})
+        sio.emit("infer_response", {"task_id": task_id, "response": ai_response,
+                                    "service_time": time.monotonic() - started})
         print(f"任务 {task_id} 推理完成，已发送结果")
 
     except Exception as e:
         print(f"任务 {task_id} 推理失败: {e}")
-        sio.emit("infer_response", {"task_id": task_id, "response": f"推理失败: {str(e)}"})
+        sio.emit("infer_response", {"task_id": task_id, "response": f"推理失败: {str(e)}", "error": True})
+
+
+def on_config_change(old, new, changed):
+    """token与公网地址在下次重连时生效，当前的Socket.IO连接不会断开"""
+    if "server_path" in changed:
+        sio.connection_url = new["server_path"]  # token由connect_auth在每次重连时读取
+
+
+def connect_auth():
+    """以函数形式传给 sio.connect，每次（重新）连接时重新调用，总是使用当前的token"""
+    return {"token": config["token"]}
+
 
+config.subscribe(on_config_change)
+config.watch()  # 断开期间没有推理请求读取配置，由后台线程检查文件
 
-# === 与转发服务器建立连接 ===
+# === 与转发服务器建立连接（模型仍在后台加载） ===
 sio.connect(
-    serve_path,
-    auth={"token": SECRET_TOKEN},   # 携带 token 认证
+    config["server_path"],
+    auth=connect_auth,   # 携带 token 认证
     wait_timeout=30,
     transports=["websocket", "polling"]  # 优先用 websocket，失败再回退到 polling
 )
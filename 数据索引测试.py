@@ -4,7 +4,7 @@
 import json
 import faiss
 from sentence_transformers import SentenceTransformer
-from datetime import datetime, timedelta
+from time_window import TimeWindowIndex
 ''''# 打开训练数据并读取
 with open("templates/聊天记录1.json", "r", encoding="utf-8") as f:
     documents = json.load(f)
@@ -31,9 +31,8 @@ D, I = index.search(a, k=1)
 with open("templates/聊天记录1.json", "r", encoding="utf-8") as f:
     documents = json.load(f)
 
-# 提取每条对话的时间戳，并将其转换为字符串类型
-for i in range(len(documents)):
-    documents[i]["时间"] = str(documents[i]["时间"])
+# 按时间排序并预先转换时间戳，之后的时间范围查询只需二分查找
+timeline = TimeWindowIndex(documents)
 
 # 加载m3e-base模型
 embedding_model = SentenceTransformer("models/m3e-base")
@@ -56,25 +55,9 @@ query_sentence = "你还记得那天和你聊天的后期干员叫什么名字
 # 对查询句子进行编码
 query_embedding = embedding_model.encode([query_sentence])
 
-# 查找最接近的句子
-D, I = index.search(query_embedding, k=1)
-
-# 获取找到的句子的索引
-a = I[0][0]
-query_time = documents[a]["时间"]
-
-# 将字符串时间转换为datetime对象
-query_time_dt = datetime.strptime(query_time, "%Y-%m-%d %H:%M:%S")
-
-# 计算前后15分钟的时间范围
-start_time = query_time_dt - timedelta(minutes=15)
-end_time = query_time_dt + timedelta(minutes=15)
-
-# 筛选出在时间范围内的对话
-relevant_dialogues = []
-for doc in documents:
-    doc_time_dt = datetime.strptime(doc["时间"], "%Y-%m-%d %H:%M:%S")
-    if start_time <= doc_time_dt <= end_time:
-        relevant_dialogues.append(doc)
-print(relevant_dialogues[0])
+# 查找最接近的3句，取出每句前后15分钟内的对话，重叠的时间段合并为一个窗口
+relevant_windows = timeline.search(index, query_embedding, k=3, before=15 * 60, after=15 * 60)
+for window in relevant_windows:
+    print(f"{window[0]['时间']} ~ {window[-1]['时间']}，共 {len(window)} 条")
+print(relevant_windows[0][0])
 